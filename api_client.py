@@ -0,0 +1,41 @@
+import threading
+
+from downloader import make_session
+from http_retry import RequestStats, RetryPolicy, TokenBucket
+
+API_URL = 'https://api.groupme.com/v3'
+REQUEST_TIMEOUT = 60
+
+
+class ApiClient(object):
+    def __init__(self, max_in_flight=4, requests_per_second=None,
+                 burst=None, max_retries=5):
+        self.configure(max_in_flight, requests_per_second, burst,
+                       max_retries)
+
+    def configure(self, max_in_flight=4, requests_per_second=None,
+                  burst=None, max_retries=5):
+        # Every chat archived by this process shares the same session,
+        # in-flight budget and request rate
+        self.max_in_flight = max_in_flight
+        self.session = make_session(max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.bucket = TokenBucket(requests_per_second, burst) \
+            if requests_per_second else None
+        self.stats = RequestStats('api')
+        self.retry_policy = RetryPolicy(max_retries, stats=self.stats)
+
+    def send(self, url, params, headers):
+        with self.in_flight:
+            if self.bucket:
+                self.stats.record_throttle(self.bucket.acquire())
+            return self.session.get(url, params=params, headers=headers,
+                                    timeout=REQUEST_TIMEOUT)
+
+    def get(self, url, params=None, headers=None):
+        # The in-flight slot is released while backing off so that other
+        # chats can keep using it
+        response = self.retry_policy.call(
+            lambda: self.send(url, params, headers))
+        self.stats.record_bytes(len(response.content))
+        return response
@@ -1,33 +1,62 @@
 import argparse
-import glob
-import json
+import contextvars
 import os
-import requests
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 from tabulate import tabulate
 
+import archive_sqlite
+import json_codec
+import media_manifest
+import message_store
+import run_metrics
+import segment_store
+import thumbnails
+from api_client import API_URL, ApiClient
+from downloader import MediaDownloader
+from http_retry import RequestStats, RetryPolicy
+from media_store import MediaStore
 
-def list_groups(args):
+SYNC_STATE_FILE = "sync_state.json"
+BACKFILL_FILE = "messages.backfill.jsonl"
+SEGMENT_FILE = "messages.backfill-%d.jsonl"
+
+# Shared by every chat archived in this process, configured in main()
+api = ApiClient()
+async_engine = None
+
+
+def log(args, message):
+    # Per-chat output is silenced when many chats are archived at once
+    if args.verbose:
+        print(message)
+
+
+def list_chats(args, url, params):
+    with run_metrics.phase('listing'):
+        if async_engine is not None:
+            return async_engine.list_chats(url, params)
+        return fetch_chat_listing(url, params)
+
+
+def fetch_chat_listing(url, params):
     headers = {'Content-Type': 'application/json'}
     page_num = 1
     listing_complete = False
 
     chats = []
     while not listing_complete:
-        params = {
-            'token': args.token,
-            'omit':  'memberships',
-            'page':  page_num
-        }
-        r = requests.get('https://api.groupme.com/v3/groups',
-                         headers=headers, params=params)
+        r = api.get(url, headers=headers,
+                    params=dict(params, page=page_num))
 
-        current_chats = json.loads(r.content)
+        r.raise_for_status()
+        current_chats = json_codec.loads(r.content)
 
-        for chat in current_chats['response']:
-            chats.append((chat['name'], chat['id'], chat['messages']['count']))
+        chats += current_chats['response']
 
         page_num += 1
         if len(current_chats['response']) == 0:
@@ -36,48 +65,72 @@ def list_groups(args):
     return chats
 
 
-def list_dms(args):
-    headers = {'Content-Type': 'application/json'}
-    page_num = 1
-    listing_complete = False
+def list_groups(args):
+    params = {
+        'token': args.token,
+        'omit':  'memberships'
+    }
 
     chats = []
-    while not listing_complete:
-        params = {
-            'token': args.token,
-            'page':  page_num
-        }
-        r = requests.get('https://api.groupme.com/v3/chats',
-                         headers=headers, params=params)
+    for chat in list_chats(args, '%s/groups' % (args.api_url), params):
+        chats.append((chat['name'], chat['id'], chat['messages']['count']))
 
-        current_chats = json.loads(r.content)
+    return chats
 
-        for chat in current_chats['response']:
-            chats.append((
-                        chat['other_user']['name'],
-                        chat['other_user']['id'],
-                        chat['messages_count']
-                        ))
 
-        page_num += 1
-        if len(current_chats['response']) == 0:
-            listing_complete = True
+def list_dms(args):
+    params = {
+        'token': args.token
+    }
+
+    chats = []
+    for chat in list_chats(args, '%s/chats' % (args.api_url), params):
+        chats.append((
+                    chat['other_user']['name'],
+                    chat['other_user']['id'],
+                    chat['messages_count']
+                    ))
 
     return chats
 
 
-def fetch_group_messages(args):
+def load_sync_state(output_dir):
+    state_file = os.path.join(output_dir, SYNC_STATE_FILE)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, encoding='utf-8') as fp:
+        return json_codec.load(fp)
+
+
+def save_sync_state(output_dir, state):
+    # Write to a temporary file first so a crash never leaves a
+    # half-written state file behind
+    state_file = os.path.join(output_dir, SYNC_STATE_FILE)
+    with open(state_file + '.tmp', 'w', encoding='utf-8') as fp:
+        json_codec.dump(state, fp)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def load_people(output_dir):
+    people_file = os.path.join(output_dir, "people.json")
+    if not os.path.exists(people_file):
+        return {}
+    with open(people_file, encoding='utf-8') as fp:
+        return json_codec.load(fp)
+
+
+def fetch_group_info(args):
     params = {
         'token': args.token
     }
-    url = 'https://api.groupme.com/v3/groups/%s' % (args.group_chat_id)
-    r = requests.get(url, params=params)
+    url = '%s/groups/%s' % (args.api_url, args.group_chat_id)
+    r = api.get(url, params=params)
+    r.raise_for_status()
 
     people = {}
-    messages = []
     group_info = {}
 
-    response = json.loads(r.content)['response']
+    response = json_codec.loads(r.content)['response']
 
     group_info['name'] = response['name']
     group_info['description'] = response['description']
@@ -91,143 +144,673 @@ def fetch_group_messages(args):
         else:
             people[member['user_id']]['avatar_url'] = None
 
-    url = 'https://api.groupme.com/v3/groups/%s/messages' % (
-           args.group_chat_id)
-    r = requests.get(url, params=params)
-
-    curr_messages = json.loads(r.content)
-
-    # TODO Check for validity of request
-    num_total_messages = curr_messages['response']['count']
-    num_fetched_messages = 0
-    curr_messages = curr_messages['response']['messages']
-    all_attachments = []
-
-    print("Fetching %d messages..." % (num_total_messages))
-    pbar = tqdm(total=num_total_messages)
-    while num_fetched_messages < num_total_messages:
-        num_fetched_messages += len(curr_messages)
-        pbar.update(len(curr_messages))
-        for message in curr_messages:
-            if message['sender_id'] not in people:
-                people[message['sender_id']] = {
-                    'name': message['name'],
-                    'avatar_url': message['avatar_url']
-                }
-            if not args.save_global_avatars and \
-               people[message['sender_id']]['avatar_url'] is None:
-                people[message['sender_id']]['avatar_url'] = \
-                    message['avatar_url']
-
-            for att in message['attachments']:
-                if att['type'] == 'image' or \
-                   att['type'] == 'video' or \
-                   att['type'] == 'linked_image':
-                    all_attachments.append(att['url'])
-            # print("[%s] %s : %s" % (
-            #    message['created_at'], message['name'], message['text']))
-            messages.append({
-                'author': message['sender_id'],
-                'created_at': message['created_at'],
-                'text': message['text'],
-                'favorited_by': message['favorited_by'],
-                'attachments': message['attachments']
-            })
-        last_message_id = curr_messages[-1]['id']
-
-        params = {
-            'token': args.token,
-            'before_id': last_message_id,
-            'limit': args.num_messages_per_request
-        }
-        url = 'https://api.groupme.com/v3/groups/%s/messages' % (
-               args.group_chat_id)
-        r = requests.get(url, params=params)
-
-        if r.status_code == 304:
-            break
-        curr_messages = json.loads(r.content)
-
-        # TODO Check for validity of request
-        curr_messages = curr_messages['response']['messages']
+    return people, group_info
 
-    pbar.close()
-    messages = list(reversed(messages))
-
-    return messages, people, group_info, all_attachments
 
-
-def fetch_direct_messages(args):
+def fetch_direct_info(args):
     params = {
         'token': args.token,
         'other_user_id': args.direct_chat_id
     }
-    url = 'https://api.groupme.com/v3/direct_messages'
-    r = requests.get(url, params=params)
+    url = '%s/direct_messages' % (args.api_url)
+    r = api.get(url, params=params)
+    r.raise_for_status()
 
     people = {}
-    messages = []
     group_info = {}
 
-    curr_messages = json.loads(r.content)
+    # An empty chat has no messages to look the other user up in
+    if r.status_code != 304:
+        for message in json_codec.loads(r.content)['response'][
+                'direct_messages']:
+            add_person(args, people, message)
+
+    if args.direct_chat_id in people:
+        group_info['name'] = people[args.direct_chat_id]['name']
+        group_info['image_url'] = people[args.direct_chat_id]['avatar_url']
+    else:
+        # The other user has not spoken recently, look them up in the
+        # chat listing instead
+        for name, user_id, _ in list_dms(args):
+            if user_id == args.direct_chat_id:
+                group_info['name'] = name
+                group_info['image_url'] = None
+                break
+        else:
+            group_info['name'] = args.direct_chat_id
+            group_info['image_url'] = None
+
+    return people, group_info
+
+
+def add_person(args, people, message):
+    if message['sender_id'] not in people:
+        people[message['sender_id']] = {
+            'name': message['name'],
+            'avatar_url': message['avatar_url']
+        }
+    if not args.save_global_avatars and \
+       people[message['sender_id']]['avatar_url'] is None:
+        people[message['sender_id']]['avatar_url'] = \
+            message['avatar_url']
+
+
+def archive_message(message):
+    return message_store.Message(message['id'], message['sender_id'],
+                                 message['created_at'], message['text'],
+                                 message['favorited_by'],
+                                 message['attachments'])
+
+
+def message_attachments(message):
+    return [att['url'] for att in message.attachments
+            if att['type'] == 'image' or
+            att['type'] == 'video' or
+            att['type'] == 'linked_image']
+
+
+def fetch_messages_page(url, params, response_key):
+    r = api.get(url, params=params)
+    if r.status_code == 304:
+        return 0, []
+    r.raise_for_status()
+
+    with run_metrics.phase('parse'):
+        response = json_codec.loads(r.content)['response']
+    return response['count'], response[response_key]
+
+
+def iter_message_pages(url, params, response_key, cursor, is_last=None):
+    # Yields (count, messages) for each page, paging with the cursor
+    # parameter, while the following page is already being requested so
+    # that storing a page overlaps with fetching the next one. Nothing is
+    # requested past a page for which is_last() is true.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(contextvars.copy_context().run,
+                                 fetch_messages_page, url, params,
+                                 response_key)
+        while future is not None:
+            count, messages = future.result()
+            if len(messages) == 0:
+                return
+            future = None
+            if is_last is None or not is_last(count, messages):
+                params = dict(params, **{cursor: messages[-1]['id']})
+                future = executor.submit(contextvars.copy_context().run,
+                                         fetch_messages_page, url, params,
+                                         response_key)
+            yield count, messages
+
+
+class AttachmentDownloads(object):
+    # Starts downloading attachments as soon as the messages they are in
+    # have been fetched, instead of after the whole history
+    def __init__(self, downloader, output_dir, manifest):
+        self.downloader = downloader
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.attachments_path = os.path.join(output_dir, 'attachments/')
+        os.makedirs(self.attachments_path, exist_ok=True)
+        self.file_names = {}
+        self.futures = {}
+
+    def add(self, urls):
+        for att_url in urls:
+            file_name = media_manifest.attachment_key(att_url)
+            att_path = os.path.join(self.attachments_path, file_name)
+            if file_name in self.manifest['attachments'] or \
+               att_path in self.file_names:
+                continue
+            self.file_names[att_path] = file_name
+            # Recorded under the attachments phase whenever they start
+            with run_metrics.phase('attachments'):
+                future = self.downloader.submit(att_url, att_path)
+            self.futures[future] = (att_url, att_path)
+
+    def wait(self, progress=True):
+        with run_metrics.phase('attachments'):
+            downloaded, _, size = self.downloader.wait_all(self.futures,
+                                                           progress)
+        for path, file_path in downloaded.items():
+            self.manifest['attachments'][self.file_names[path]] = \
+                os.path.relpath(file_path, self.output_dir).replace(
+                    os.sep, '/')
+        return size
+
+
+def new_segment(before_id, stop_id, file_name):
+    return {'before_id': before_id, 'stop_id': stop_id, 'file': file_name,
+            'people': {}}
+
+
+def seed_segments(args, url, params, response_key):
+    # Splits a full backfill into segments, newest first, that are paged
+    # back through at the same time. Message ids grow over time, so ids
+    # spread evenly between the oldest and newest message split the
+    # history into roughly even parts. A segment starts before the upper
+    # split id and stops before the lower one, so every message falls in
+    # exactly one segment.
+    num_total_messages, newest = fetch_messages_page(
+        url, dict(params, limit=1), response_key)
+    _, oldest = fetch_messages_page(url, dict(params, after_id=0, limit=1),
+                                    response_key)
+    num_pages = -(-num_total_messages // int(args.num_messages_per_request))
+    num_segments = min(args.backfill_cursors, num_pages)
+    if num_segments <= 1 or not newest or not oldest:
+        return [new_segment(None, None, BACKFILL_FILE)]
+
+    low = int(oldest[0]['id'])
+    high = int(newest[0]['id']) + 1
+    segments = []
+    before_id = None
+    for i in range(num_segments - 1, 0, -1):
+        split_id = low + (high - low) * i // num_segments
+        segments.append(new_segment(before_id, str(split_id - 1),
+                                    SEGMENT_FILE % (len(segments))))
+        before_id = str(split_id)
+    segments.append(new_segment(before_id, str(low - 1),
+                                SEGMENT_FILE % (len(segments))))
+    return segments
+
+
+def iter_segment_pages(url, params, response_key, segments, is_last):
+    # Yields (segment, count, messages) for the pages of every segment as
+    # they arrive, each segment's in order. Segments are paged through on
+    # threads of their own while the caller stores the pages.
+    def segment_pages(segment):
+        page_params = dict(params)
+        if segment['before_id']:
+            page_params['before_id'] = segment['before_id']
+        return iter_message_pages(
+            url, page_params, response_key, 'before_id',
+            lambda count, messages: is_last(segment, count, messages))
+
+    if len(segments) == 1:
+        for count, messages in segment_pages(segments[0]):
+            yield segments[0], count, messages
+        return
+
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def walk(segment):
+        try:
+            for count, messages in segment_pages(segment):
+                if stop.is_set():
+                    break
+                pages.put((segment, count, messages))
+        finally:
+            pages.put((segment, None, None))
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, walk,
+                                   segment) for segment in segments]
+        try:
+            num_walking = len(segments)
+            while num_walking > 0:
+                segment, count, messages = pages.get()
+                if messages is None:
+                    num_walking -= 1
+                else:
+                    yield segment, count, messages
+            # Raise any error, once the other segments are stored
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+
+
+def merge_people(args, people, new_people):
+    # Same rules as add_person(), for people found in a segment
+    for k, v in new_people.items():
+        if k not in people:
+            people[k] = v
+        elif not args.save_global_avatars and \
+                people[k]['avatar_url'] is None:
+            people[k]['avatar_url'] = v['avatar_url']
+
+
+def count_backfilled(path, before_id):
+    # Messages stored up to the checkpoint, each counted once. Pages
+    # written after it get fetched again, and so may be in the file twice.
+    if before_id is None:
+        return 0
+    num_messages = 0
+    min_id = None
+    for message in message_store.iter_messages_file(path):
+        message_id = int(message.id)
+        if message_id >= int(before_id) and \
+           (min_id is None or message_id < min_id):
+            num_messages += 1
+            min_id = message_id
+    return num_messages
+
+
+def backfill_messages(args, output_dir, state, url, params, response_key,
+                      people, db=None, stop_id=None, attachments=None,
+                      can_split=False):
+    # Pages backwards through the history with before_id, appending each
+    # page to a backfill file and checkpointing the cursor in the sync
+    # state so that an interrupted run picks up where it stopped. With
+    # --backfill-cursors, a full backfill of a group is split into
+    # segments with a backfill file and cursor each.
+    backfill = state.get('backfill')
+    if backfill is None:
+        if can_split and stop_id is None and args.backfill_cursors > 1:
+            segments = seed_segments(args, url, params, response_key)
+        else:
+            segments = [new_segment(None, stop_id, BACKFILL_FILE)]
+        backfill = {'stop_id': stop_id, 'segments': segments}
+        state['backfill'] = backfill
+        for segment in segments:
+            open(os.path.join(output_dir, segment['file']), 'w').close()
+        if db is not None and stop_id is None:
+            db.clear_messages()
+    else:
+        if 'segments' not in backfill:
+            # Left by a version with a single cursor
+            backfill['segments'] = [new_segment(
+                backfill.pop('before_id'), backfill['stop_id'],
+                BACKFILL_FILE)]
+            backfill['segments'][0]['people'] = backfill.pop('people', {})
+        stop_id = backfill['stop_id']
+        segments = backfill['segments']
+        if len(segments) == 1:
+            log(args, "Resuming backfill before message %s..." % (
+                segments[0]['before_id']))
+        else:
+            log(args, "Resuming backfill of %d segments..." % (
+                len(segments)))
 
-    # TODO Check for validity of request
-    num_total_messages = curr_messages['response']['count']
     num_fetched_messages = 0
-    curr_messages = curr_messages['response']['direct_messages']
+    requested = {}
+    for segment in segments:
+        backfill_file = os.path.join(output_dir, segment['file'])
+        message_store.truncate_partial_line(backfill_file)
+        requested[segment['file']] = count_backfilled(
+            backfill_file, segment['before_id'])
+        num_fetched_messages += requested[segment['file']]
+
+    def is_last_page(segment, num_total_messages, messages):
+        # Pages are newest first, so the last message is the oldest
+        if segment['stop_id'] is not None:
+            return int(messages[-1]['id']) <= int(segment['stop_id'])
+        requested[segment['file']] += len(messages)
+        return requested[segment['file']] >= num_total_messages
+
+    page_params = dict(params, limit=args.num_messages_per_request)
+    pages = iter_segment_pages(url, page_params, response_key, segments,
+                               is_last_page)
+    files = {segment['file']: open(os.path.join(output_dir, segment['file']),
+                                   'a', encoding='utf-8')
+             for segment in segments}
+    try:
+        pending = next(pages, None)
+        num_total_messages = pending[1] if pending else 0
+
+        log(args, "Fetching %d messages..." % (num_total_messages))
+        pbar = tqdm(total=num_total_messages, initial=num_fetched_messages,
+                    disable=not args.verbose)
+        while pending is not None:
+            segment, _, curr_messages = pending
+            fp = files[segment['file']]
+            page = []
+            with run_metrics.phase('store'):
+                for message in curr_messages:
+                    if segment['stop_id'] is not None and \
+                       int(message['id']) <= int(segment['stop_id']):
+                        break
+                    add_person(args, segment['people'], message)
+                    page.append(archive_message(message))
+                    message_store.write_message(fp, page[-1])
+                fp.flush()
+                if db is not None:
+                    db.add_messages(page)
+            if attachments is not None:
+                attachments.add(url for message in page
+                                for url in message_attachments(message))
+
+            pbar.update(len(curr_messages))
+
+            segment['before_id'] = curr_messages[-1]['id']
+            with run_metrics.phase('store'):
+                save_sync_state(output_dir, state)
+
+            pending = next(pages, None)
+        pbar.close()
+    finally:
+        pages.close()
+        for fp in files.values():
+            fp.close()
+
+    for segment in segments:
+        merge_people(args, people, segment['people'])
+
+    # Backfill files are newest first, so they are read back to front,
+    # oldest segment first, to append the messages in chronological order.
+    # Pages may have been written twice if a run stopped between writing
+    # and checkpointing a page, which shows up as ids going backwards.
+    messages_file = os.path.join(output_dir, message_store.MESSAGES_FILE)
+    last_id = int(stop_id) if stop_id is not None else -1
+    num_messages = 0
     all_attachments = []
+    with run_metrics.phase('store'), \
+            open(messages_file, 'w' if stop_id is None else 'a',
+                 encoding='utf-8') as fp:
+        for segment in reversed(segments):
+            for message in message_store.iter_messages_reversed(
+                    os.path.join(output_dir, segment['file'])):
+                if int(message.id) <= last_id:
+                    continue
+                last_id = int(message.id)
+                num_messages += 1
+                all_attachments += message_attachments(message)
+                message_store.write_message(fp, message)
+
+    for segment in segments:
+        os.remove(os.path.join(output_dir, segment['file']))
+    del state['backfill']
+
+    return num_messages, all_attachments
+
+
+def fetch_newer_messages(args, output_dir, url, params, response_key, people,
+                         after_id, db=None, attachments=None):
+    # Pages come back oldest first, so they are appended to the store as
+    # they arrive and the store itself is the checkpoint
+    page_params = dict(params, after_id=after_id,
+                       limit=args.num_messages_per_request)
+
+    num_messages = 0
+    all_attachments = []
+    messages_file = os.path.join(output_dir, message_store.MESSAGES_FILE)
+    log(args, "Fetching messages after %s..." % (after_id))
+    pbar = tqdm(disable=not args.verbose)
+    with open(messages_file, 'a', encoding='utf-8') as fp:
+        for _, curr_messages in iter_message_pages(
+                url, page_params, response_key, 'after_id'):
+            pbar.update(len(curr_messages))
+            num_messages += len(curr_messages)
+            page = []
+            with run_metrics.phase('store'):
+                for message in curr_messages:
+                    add_person(args, people, message)
+                    page.append(archive_message(message))
+                    all_attachments += message_attachments(page[-1])
+                    message_store.write_message(fp, page[-1])
+                fp.flush()
+                if db is not None:
+                    db.add_messages(page)
+            if attachments is not None:
+                attachments.add(url for message in page
+                                for url in message_attachments(message))
+    pbar.close()
 
-    print("Fetching %d messages..." % (num_total_messages))
-    pbar = tqdm(total=num_total_messages)
-    while num_fetched_messages < num_total_messages:
-        num_fetched_messages += len(curr_messages)
-        pbar.update(len(curr_messages))
-        for message in curr_messages:
-            if message['sender_id'] not in people:
-                people[message['sender_id']] = {
-                    'name': message['name'],
-                    'avatar_url': message['avatar_url']
-                }
-
-            for att in message['attachments']:
-                if att['type'] == 'image' or \
-                   att['type'] == 'video' or \
-                   att['type'] == 'linked_image':
-                    all_attachments.append(att['url'])
-            # print("[%s] %s : %s" % (
-            #    message['created_at'], message['name'], message['text']))
-            messages.append({
-                'author': message['sender_id'],
-                'created_at': message['created_at'],
-                'text': message['text'],
-                'favorited_by': message['favorited_by'],
-                'attachments': message['attachments']
-            })
-        last_message_id = curr_messages[-1]['id']
-
+    return num_messages, all_attachments
+
+
+def fetch_messages(args, output_dir, url, params, response_key, people,
+                   supports_after_id, db=None, attachments=None):
+    state = load_sync_state(output_dir)
+    backfill = state.get('backfill')
+
+    messages_file = os.path.join(output_dir, message_store.MESSAGES_FILE)
+    legacy_messages_file = os.path.join(output_dir,
+                                        message_store.LEGACY_MESSAGES_FILE)
+
+    last_message_id = None
+    if args.sync or (backfill and backfill['stop_id'] is not None):
+        if not os.path.exists(messages_file) and \
+           not segment_store.has_segments(output_dir) and \
+           os.path.exists(legacy_messages_file):
+            log(args, "Converting existing messages.json...")
+            message_store.convert_archive(output_dir)
+        message_store.truncate_partial_line(messages_file)
+
+        for k, v in load_people(output_dir).items():
+            if k not in people:
+                people[k] = v
+            elif people[k]['avatar_url'] is None:
+                people[k]['avatar_url'] = v['avatar_url']
+
+        last_message = message_store.read_last_message(messages_file)
+        if last_message is not None:
+            last_message_id = last_message.id
+        if last_message_id is None:
+            last_message_id = segment_store.last_message_id(output_dir)
+        if last_message_id is None:
+            last_message_id = state.get('last_message_id')
+
+    # Whether messages.jsonl ends up with the whole history, rather than
+    # only the messages that are new since the last run
+    fetched_all = False
+    if backfill:
+        fetched_all = backfill['stop_id'] is None
+        num_messages, all_attachments = backfill_messages(
+            args, output_dir, state, url, params, response_key, people, db,
+            attachments=attachments)
+    elif args.sync and last_message_id is not None:
+        if db is not None and db.count_messages() == 0:
+            log(args, "Importing existing messages into %s..." % (
+                archive_sqlite.SQLITE_FILE))
+            if segment_store.has_segments(output_dir):
+                db.add_messages(segment_store.iter_messages(output_dir))
+            else:
+                db.add_messages(
+                    message_store.iter_messages_file(messages_file))
+        if supports_after_id:
+            num_messages, all_attachments = fetch_newer_messages(
+                args, output_dir, url, params, response_key, people,
+                last_message_id, db, attachments)
+        else:
+            num_messages, all_attachments = backfill_messages(
+                args, output_dir, state, url, params, response_key, people,
+                db, stop_id=last_message_id, attachments=attachments)
+    else:
+        if args.sync:
+            log(args, "No message ids found in existing archive, " +
+                      "fetching entire history...")
+        fetched_all = True
+        num_messages, all_attachments = backfill_messages(
+            args, output_dir, state, url, params, response_key, people, db,
+            attachments=attachments, can_split=supports_after_id)
+
+    last_message = message_store.read_last_message(messages_file)
+    if last_message is not None:
+        state['last_message_id'] = last_message.id
+    save_sync_state(output_dir, state)
+
+    if args.segments or segment_store.has_segments(output_dir):
+        with run_metrics.phase('store'):
+            segment_store.pack_messages_file(
+                output_dir, args.segment_codec, args.segment_size,
+                replace=fetched_all)
+
+    return num_messages, all_attachments
+
+
+def archive_chat(args, downloader):
+    if args.group_chat_id:
+        with run_metrics.phase('info'):
+            people, group_info = fetch_group_info(args)
+        url = '%s/groups/%s/messages' % (args.api_url, args.group_chat_id)
+        params = {
+            'token': args.token
+        }
+        response_key = 'messages'
+    else:
+        with run_metrics.phase('info'):
+            people, group_info = fetch_direct_info(args)
+        url = '%s/direct_messages' % (args.api_url)
         params = {
             'token': args.token,
-            'other_user_id': args.direct_chat_id,
-            'before_id': last_message_id,
-            'limit': args.num_messages_per_request
+            'other_user_id': args.direct_chat_id
         }
-        url = 'https://api.groupme.com/v3/direct_messages'
-        r = requests.get(url, params=params)
+        response_key = 'direct_messages'
+
+    output_dir = args.output_dir
+    if not output_dir:
+        output_dir = group_info['name']
+        output_dir = output_dir.replace('/', ' ')
+        if args.output_root:
+            # Chats archived together can share a name, so each gets its
+            # own folder
+            if args.group_chat_id:
+                chat_key = 'group-%s' % (args.group_chat_id)
+            else:
+                chat_key = 'direct-%s' % (args.direct_chat_id)
+            output_dir = os.path.join(args.output_root, '%s (%s)' % (
+                output_dir, chat_key))
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    db = None
+    if args.sqlite:
+        db = archive_sqlite.SqliteArchive(
+            os.path.join(output_dir, archive_sqlite.SQLITE_FILE))
+
+    manifest = media_manifest.load_manifest(output_dir)
+    attachments = AttachmentDownloads(downloader, output_dir, manifest)
+    num_bytes = 0
+
+    # Direct messages only support paging backwards
+    with run_metrics.phase('messages'):
+        num_messages, all_attachments = fetch_messages(
+            args, output_dir, url, params, response_key, people,
+            supports_after_id=bool(args.group_chat_id), db=db,
+            attachments=attachments)
+        run_metrics.metrics.count('messages', num_messages)
+
+    if args.direct_chat_id and args.direct_chat_id in people:
+        group_info['image_url'] = \
+            people[args.direct_chat_id]['avatar_url']
+
+    log(args, "\nFetching avatars...")
+    avatars_path = os.path.join(output_dir, 'avatars/')
+    os.makedirs(avatars_path, exist_ok=True)
+    avatar_jobs = {}
+    for k, v in people.items():
+        url = v['avatar_url']
+        if url:
+            avatar_path = os.path.join(avatars_path, '%s.avatar' % (k))
+            avatar_jobs[avatar_path] = ("%s.avatar" % (url), k)
+    with run_metrics.phase('avatars'):
+        downloaded, _, size = downloader.fetch_all(
+            [(url, path) for path, (url, _) in avatar_jobs.items()],
+            progress=args.verbose)
+    num_bytes += size
+    for path, file_path in downloaded.items():
+        manifest['avatars'][avatar_jobs[path][1]] = \
+            os.path.relpath(file_path, output_dir).replace(os.sep, '/')
+
+    # Most attachments are already downloading by now. Those of pages
+    # fetched by an earlier, interrupted run are only found once the
+    # backfill is merged into the store.
+    log(args, "\nFetching attachments...")
+    attachments.add(all_attachments)
+    num_bytes += attachments.wait(progress=args.verbose)
+
+    with run_metrics.phase('saving'):
+        media_manifest.save_manifest(output_dir, manifest)
+
+    if args.thumbnails:
+        log(args, "\nMaking thumbnails...")
+        with run_metrics.phase('thumbnails'):
+            thumbnails.generate_thumbnails(output_dir,
+                                           progress=args.verbose)
+
+    if args.verbose:
+        print("\nPeople:")
+        table_headers = {
+            "id": "ID",
+            "name": "Name",
+            "avatar_url": "Avatar URL"
+        }
+        print(tabulate([dict({'id': k}, **v) for (k, v) in people.items()],
+                       headers=table_headers))
 
-        if r.status_code == 304:
-            break
-        curr_messages = json.loads(r.content)
+    # Save everything
+    people_file = os.path.join(output_dir, "people.json")
+    group_info_file = os.path.join(output_dir, "group_info.json")
 
-        # TODO Check for validity of request
-        curr_messages = curr_messages['response']['direct_messages']
+    with run_metrics.phase('saving'):
+        # Save people
+        with open(people_file, 'w', encoding='utf-8') as fp:
+            json_codec.dump(people, fp, indent=2)
 
-    pbar.close()
-    messages = list(reversed(messages))
+        # Save group information
+        with open(group_info_file, 'w', encoding='utf-8') as fp:
+            json_codec.dump(group_info, fp, indent=2)
+
+        if db is not None:
+            db.save_people(people)
+            db.save_group_info(group_info)
+            db.close()
 
-    group_info['name'] = people[args.direct_chat_id]['name']
-    group_info['image_url'] = people[args.direct_chat_id]['avatar_url']
+    return group_info['name'], num_messages, num_bytes
 
-    return messages, people, group_info, all_attachments
+
+def read_chat_ids(ids_file):
+    # One chat per line, as "group <id>" or "direct <id>"
+    chats = []
+    with open(ids_file, encoding='utf-8') as fp:
+        for line in fp:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            chat_type, chat_id = line.split()
+            if chat_type not in ('group', 'direct'):
+                raise ValueError("Unknown chat type '%s' in %s" % (
+                    chat_type, ids_file))
+            chats.append((chat_type, chat_id))
+    return chats
+
+
+def chat_args(args, chat_type, chat_id):
+    chat_args = argparse.Namespace(**vars(args))
+    chat_args.group_chat_id = chat_id if chat_type == 'group' else None
+    chat_args.direct_chat_id = chat_id if chat_type == 'direct' else None
+    chat_args.output_dir = None
+    chat_args.output_root = args.output_dir
+    chat_args.verbose = False
+    return chat_args
+
+
+def archive_all(args, downloader):
+    chats = []
+    if args.all:
+        chats += [('group', chat_id) for _, chat_id, _ in list_groups(args)]
+        chats += [('direct', chat_id) for _, chat_id, _ in list_dms(args)]
+    if args.ids_file:
+        chats += read_chat_ids(args.ids_file)
+    # A chat both listed and in the ids file is only archived once
+    chats = list(dict.fromkeys(chats))
+
+    summary = []
+    print("Archiving %d chats..." % (len(chats)))
+    pbar = tqdm(total=len(chats))
+    with ThreadPoolExecutor(max_workers=args.chat_workers) as executor:
+        futures = {executor.submit(archive_chat,
+                                   chat_args(args, chat_type, chat_id),
+                                   downloader): (chat_type, chat_id)
+                   for chat_type, chat_id in chats}
+        for future in as_completed(futures):
+            chat_type, chat_id = futures[future]
+            try:
+                name, num_messages, num_bytes = future.result()
+                summary.append((name, chat_type, chat_id, num_messages,
+                                tqdm.format_sizeof(num_bytes, 'B'), 'ok'))
+            except Exception as e:
+                tqdm.write("Failed to archive %s %s: %s" % (
+                    chat_type, chat_id, e))
+                summary.append(('', chat_type, chat_id, 0, '0B', 'failed'))
+            pbar.update(1)
+    pbar.close()
+
+    print("")
+    table_headers = ["Chat Name", "Type", "ID", "Messages fetched",
+                     "Downloaded", "Status"]
+    print(tabulate(sorted(summary), headers=table_headers))
 
 
 def main():
@@ -243,6 +826,11 @@ def main():
                         help="Group chat ID to archive")
     parser.add_argument('--direct-chat-id', '-d', dest="direct_chat_id",
                         help="Direct Message chat ID to archive")
+    parser.add_argument('--all', action='store_true',
+                        help="Archive all listed group and direct chats")
+    parser.add_argument('--ids-file', dest='ids_file',
+                        help="File listing chats to archive, one " +
+                             "'group <id>' or 'direct <id>' per line")
 
     parser.add_argument('--num-messages-per-request', '-n', default=20,
                         dest='num_messages_per_request',
@@ -255,9 +843,118 @@ def main():
                         help="Use global avatars instead of " +
                              "chat specific user avatars")
 
-    args = parser.parse_args()
+    parser.add_argument('--sync', action='store_true',
+                        help="Only fetch messages newer than the ones " +
+                             "already in the output directory")
+
+    parser.add_argument('--sqlite', action='store_true',
+                        help="Also write the archive to an indexed " +
+                             "SQLite database, archive.sqlite")
+
+    parser.add_argument('--segments', action='store_true',
+                        help="Store messages in compressed segments with " +
+                             "an index instead of messages.jsonl")
+    parser.add_argument('--segment-codec', choices=segment_store.CODECS,
+                        dest='segment_codec',
+                        help="Compression for --segments (default: gzip). " +
+                             "zstd needs the zstandard package")
+    parser.add_argument('--segment-size', type=int, dest='segment_size',
+                        help="Number of messages per segment (default: " +
+                             "%d)" % (segment_store.SEGMENT_SIZE))
+    parser.add_argument('--compact-json', action='store_true',
+                        dest='compact_json',
+                        help="Write the archive's JSON files without " +
+                             "indentation or spaces, which is quicker " +
+                             "and smaller")
+
+    parser.add_argument('--thumbnails', action='store_true',
+                        help="Make thumbnails of image attachments and " +
+                             "poster frames of videos for the rendered " +
+                             "chat (requires Pillow and ffmpeg)")
+
+    parser.add_argument('--media-store', dest='media_store',
+                        help="Folder of avatars and attachments shared " +
+                             "between archives. Media already in it is " +
+                             "linked into the archive instead of being " +
+                             "downloaded again")
+
+    parser.add_argument('--download-workers', default=8, type=int,
+                        dest='download_workers',
+                        help="Number of parallel avatar/attachment downloads")
+    parser.add_argument('--download-host-limit', default=4, type=int,
+                        dest='download_host_limit',
+                        help="Maximum parallel downloads from a single host")
+    parser.add_argument('--chat-workers', default=4, type=int,
+                        dest='chat_workers',
+                        help="Number of chats archived in parallel with " +
+                             "--all or --ids-file")
+    parser.add_argument('--api-concurrency', default=4, type=int,
+                        dest='api_concurrency',
+                        help="Maximum parallel requests to the GroupMe API")
+    parser.add_argument('--max-requests-per-second', type=float,
+                        dest='max_requests_per_second',
+                        help="Limit on the GroupMe API request rate, " +
+                             "shared by all chats")
+    parser.add_argument('--request-burst', type=int,
+                        dest='request_burst',
+                        help="Number of API requests that may be sent " +
+                             "at once before --max-requests-per-second " +
+                             "applies")
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help="Fetch chat listings and media concurrently " +
+                             "on an asyncio event loop (requires aiohttp)")
+    parser.add_argument('--api-url', default=API_URL, dest='api_url',
+                        help="Base URL of the GroupMe API, for e.g. a " +
+                             "local mock server (default: %s)" % (API_URL))
+    parser.add_argument('--backfill-cursors', default=1, type=int,
+                        dest='backfill_cursors',
+                        help="Number of points in a group chat's history " +
+                             "that a full backfill pages back from at once")
+    parser.add_argument('--max-retries', default=5, type=int,
+                        dest='max_retries',
+                        help="Number of times a throttled or failed " +
+                             "request is retried")
+    parser.add_argument('--metrics-file', dest='metrics_file',
+                        help="Save the time spent in each phase, with " +
+                             "request counts, latencies, bytes and " +
+                             "retries, to this file as JSON or, for files " +
+                             "ending in .prom, in the Prometheus text " +
+                             "format.")
 
-    if not args.group_chat_id and not args.direct_chat_id:
+    args = parser.parse_args()
+    args.output_root = None
+    args.verbose = True
+
+    if args.segment_codec == 'zstd' and segment_store.zstandard is None:
+        print("--segment-codec zstd requires the zstandard package")
+        sys.exit(1)
+
+    json_codec.configure(args.compact_json)
+    api.configure(args.api_concurrency, args.max_requests_per_second,
+                  args.request_burst, args.max_retries)
+    media_retry_policy = RetryPolicy(args.max_retries,
+                                     stats=RequestStats('media'))
+    media_store = MediaStore(args.media_store) if args.media_store else None
+
+    global async_engine
+    if args.use_async:
+        try:
+            from async_engine import AsyncEngine
+        except ImportError:
+            print("--async requires the aiohttp package")
+            sys.exit(1)
+        async_engine = AsyncEngine(args.download_workers,
+                                   args.download_host_limit, api,
+                                   media_retry_policy, media_store)
+
+    downloader = async_engine or \
+        MediaDownloader(args.download_workers, args.download_host_limit,
+                        retry_policy=media_retry_policy,
+                        media_store=media_store)
+
+    if args.all or args.ids_file:
+        archive_all(args, downloader)
+    elif not args.group_chat_id and not args.direct_chat_id:
         print("Group chats")
         print("===========")
         chats = list_groups(args)
@@ -271,74 +968,15 @@ def main():
         table_headers = ["Chat Name", "ID", "Number of messages"]
         print(tabulate(chats, headers=table_headers))
     else:
-        if args.group_chat_id:
-            messages, people, group_info, all_attachments = \
-                fetch_group_messages(args)
-        else:
-            messages, people, group_info, all_attachments = \
-                fetch_direct_messages(args)
-
-        output_dir = args.output_dir
-        if not output_dir:
-            output_dir = group_info['name']
-            output_dir = output_dir.replace('/', ' ')
-
-        os.makedirs(output_dir, exist_ok=True)
-
-        print("\nFetching avatars...")
-        avatars_path = os.path.join(output_dir, 'avatars/')
-        os.makedirs(avatars_path, exist_ok=True)
-        for k, v in tqdm(people.items()):
-            url = v['avatar_url']
-            if url:
-                r = requests.get("%s.avatar" % (url))
-                img_type = r.headers['content-type'].split('/')[1]
-                avatar_path = os.path.join(avatars_path,
-                                           '%s.avatar.%s' % (k, img_type))
-                with open(avatar_path, 'wb') as fp:
-                    fp.write(r.content)
-
-        print("\nFetching attachments...")
-        attachments_path = os.path.join(output_dir, 'attachments/')
-        os.makedirs(attachments_path, exist_ok=True)
-        for att_url in tqdm(all_attachments):
-            file_name = att_url.split('/')[-1]
-            att_path = 'attachments/%s.%s' % (file_name, "*")
-            att_full_path = os.path.join(output_dir, att_path)
-            if len(glob.glob(att_full_path)) == 0:
-                r = requests.get(att_url)
-                img_type = r.headers['content-type'].split('/')[1]
-                att_path = 'attachments/%s.%s' % (file_name, img_type)
-                att_full_path = os.path.join(output_dir, att_path)
-
-                with open(att_full_path, 'wb') as fp:
-                    fp.write(r.content)
-
-        print("\nPeople:")
-        table_headers = {
-            "id": "ID",
-            "name": "Name",
-            "avatar_url": "Avatar URL"
-        }
-        print(tabulate([dict({'id': k}, **v) for (k, v) in people.items()],
-                       headers=table_headers))
-
-        # Save everything
-        people_file = os.path.join(output_dir, "people.json")
-        messages_file = os.path.join(output_dir, "messages.json")
-        group_info_file = os.path.join(output_dir, "group_info.json")
+        archive_chat(args, downloader)
 
-        # Save people
-        with open(people_file, 'w', encoding='utf-8') as fp:
-            json.dump(people, fp, ensure_ascii=False, indent=2)
+    downloader.close()
 
-        # Save messages
-        with open(messages_file, 'w', encoding='utf-8') as fp:
-            json.dump(messages, fp, ensure_ascii=False, indent=2)
-
-        # Save group information
-        with open(group_info_file, 'w', encoding='utf-8') as fp:
-            json.dump(group_info, fp, ensure_ascii=False, indent=2)
+    print("\nAPI: %s" % (api.stats.summary()))
+    if media_retry_policy.stats.num_requests > 0:
+        print("Media: %s" % (media_retry_policy.stats.summary()))
+    if args.metrics_file:
+        run_metrics.metrics.save(args.metrics_file, 'archive_chat')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,530 @@
+import calendar
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import email.utils
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+import mimetypes
+import os
+import re
+import threading
+from urllib.parse import parse_qs, unquote, urlparse
+
+import media_manifest
+import message_store
+import segment_store
+import thumbnails
+
+CACHE_SIZE = 64
+WINDOW_SIZE = 1000
+BLOCK_SIZE = segment_store.SEGMENT_SIZE
+COPY_SIZE = 64 * 1024
+
+# Archive files that pages are rendered from. Pages are rendered again,
+# and get new ETags, once any of them changes.
+SOURCE_FILES = ('people.json', 'group_info.json',
+                media_manifest.MANIFEST_FILE, thumbnails.THUMBNAILS_FILE,
+                message_store.MESSAGES_FILE,
+                os.path.join(segment_store.SEGMENTS_DIR,
+                             segment_store.INDEX_FILE))
+MEDIA_DIRS = ('avatars', 'attachments', thumbnails.THUMBNAILS_DIR)
+
+MONTH_PAGE = re.compile(r'rendered-(\d{4})-(\d{2})\.html$')
+DAY_PAGE = re.compile(r'rendered-(\d{4})-(\d{2})-(\d{2})\.html$')
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def archive_version(archive_dir):
+    version = []
+    for file_name in SOURCE_FILES:
+        try:
+            stat = os.stat(os.path.join(archive_dir, file_name))
+        except FileNotFoundError:
+            version.append(None)
+            continue
+        version.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return tuple(version)
+
+
+def scan_blocks(path, offset=0, block_size=BLOCK_SIZE):
+    # Splits messages.jsonl into blocks of block_size lines, listed with
+    # the same ids and times as segments are, so that a range of messages
+    # is read from the blocks it falls in. A half-written last line is
+    # left for the next scan.
+    blocks = []
+    block = None
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            if block is None or block['lines'] == block_size:
+                block = {'offset': offset, 'length': 0, 'lines': 0,
+                         'count': 0, 'first_id': None, 'last_id': None,
+                         'start_time': None, 'end_time': None}
+                blocks.append(block)
+            block['lines'] += 1
+            block['length'] += len(line)
+            offset += len(line)
+
+            message = message_store.parse_line(line)
+            if message is None:
+                continue
+            if block['count'] == 0:
+                block['first_id'] = message.id
+                block['start_time'] = block['end_time'] = message.created_at
+            block['count'] += 1
+            block['last_id'] = message.id
+            block['start_time'] = min(block['start_time'], message.created_at)
+            block['end_time'] = max(block['end_time'], message.created_at)
+    return blocks
+
+
+def read_block(path, block):
+    with open(path, 'rb') as fp:
+        fp.seek(block['offset'])
+        data = fp.read(block['length'])
+    messages = []
+    for line in data.split(b'\n'):
+        message = message_store.parse_line(line) if line else None
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+class ArchiveSource(object):
+    # Reads ranges of messages from segments and blocks of messages.jsonl,
+    # skipping the ones a range does not overlap. As messages.jsonl is only
+    # appended to between syncs, a refresh only scans its last block and
+    # whatever was added after it.
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.messages_file = os.path.join(archive_dir,
+                                          message_store.MESSAGES_FILE)
+        self.segments = []
+        self.blocks = []
+        self.scanned = None
+
+    def refresh(self):
+        self.segments = segment_store.load_index(
+            self.archive_dir)['segments']
+        if not os.path.exists(self.messages_file):
+            self.blocks = []
+            self.scanned = None
+            return
+
+        stat = os.stat(self.messages_file)
+        offset = 0
+        if self.blocks and self.scanned == stat.st_ino and \
+           stat.st_size >= self.blocks[-1]['offset'] + \
+           self.blocks[-1]['length']:
+            offset = self.blocks.pop()['offset']
+        else:
+            self.blocks = []
+        self.blocks.extend(scan_blocks(self.messages_file, offset))
+        self.scanned = stat.st_ino
+
+    def entries(self):
+        return [entry for entry in self.segments + self.blocks
+                if entry['count']]
+
+    def read_entry(self, entry):
+        if 'file' in entry:
+            return segment_store.read_segment(self.archive_dir, entry)
+        messages = read_block(self.messages_file, entry)
+        if self.segments:
+            # Left behind by a run that stopped before removing them
+            last_id = self.segments[-1]['last_id']
+            messages = [message for message in messages
+                        if message.id is None or
+                        int(message.id) > int(last_id)]
+        return messages
+
+    def iter_messages(self, first_id=None, last_id=None, start_time=None,
+                      end_time=None, reverse=False):
+        entries = self.entries()
+        if reverse:
+            entries.reverse()
+        for entry in entries:
+            if not segment_store.overlaps(entry, first_id, last_id,
+                                          start_time, end_time):
+                continue
+            messages = [message for message in self.read_entry(entry)
+                        if segment_store.matches(message, first_id, last_id,
+                                                 start_time, end_time)]
+            if reverse:
+                messages.reverse()
+            yield from messages
+
+    def months(self, timezone=None):
+        # Every month from the first to the last message of each entry
+        months = set()
+        for entry in self.entries():
+            month = local_month(entry['start_time'], timezone)
+            last_month = local_month(entry['end_time'], timezone)
+            while month <= last_month:
+                months.add(month)
+                month = next_month(*month)
+        return sorted(months)
+
+    def id_bounds(self):
+        ids = [int(entry[key]) for entry in self.entries()
+               for key in ('first_id', 'last_id') if entry[key] is not None]
+        if not ids:
+            return None, None
+        return min(ids), max(ids)
+
+
+class PageCache(object):
+    # Rendered pages, least recently used first, taking up at most
+    # max_size bytes
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def put(self, key, page):
+        if len(page) > self.max_size:
+            return
+        with self.lock:
+            if key in self.pages:
+                self.size -= len(self.pages.pop(key))
+            self.pages[key] = page
+            self.size += len(page)
+            while self.size > self.max_size:
+                _, evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def local_date(timestamp, timezone=None):
+    return datetime.fromtimestamp(timestamp, timezone).strftime('%b %d, %Y')
+
+
+def local_month(timestamp, timezone=None):
+    moment = datetime.fromtimestamp(timestamp, timezone)
+    return moment.year, moment.month
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def day_start(day, timezone=None):
+    # First second of a local day. DST changes can skip or repeat local
+    # midnight, so it is found by bisection instead of by localizing it.
+    target = (day.year, day.month, day.day)
+    middle = calendar.timegm(target + (0, 0, 0))
+    low, high = middle - 2 * 86400, middle + 2 * 86400
+    while low < high:
+        middle = (low + high) // 2
+        moment = datetime.fromtimestamp(middle, timezone)
+        if (moment.year, moment.month, moment.day) < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def parse_range(header, size):
+    # Returns the (first, last) byte of a single range, None to send the
+    # whole file, which multiple ranges and other units get, or False when
+    # the range starts past the end of the file
+    match = BYTE_RANGE.match(header.strip())
+    if not match or not any(match.groups()) or size == 0:
+        return None
+    first, last = match.groups()
+    if not first:
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        return False
+    if last < first:
+        return None
+    return first, last
+
+
+def content_type(path):
+    # Attachments are saved with the subtype they were served as
+    guessed = mimetypes.guess_type(path)[0]
+    if guessed:
+        return guessed
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension in thumbnails.VIDEO_TYPES:
+        return 'video/%s' % (extension)
+    if extension in thumbnails.IMAGE_TYPES + ('gif',):
+        return 'image/%s' % (extension)
+    return 'application/octet-stream'
+
+
+def etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in header.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+
+def refresh(server):
+    # Picks up changes to the archive, e.g. from a sync while serving, and
+    # returns a tag that changes with them
+    version = archive_version(server.archive_dir)
+    with server.lock:
+        if version != server.version:
+            server.pages.load()
+            server.source.refresh()
+            server.months = server.source.months(server.timezone)
+            server.version = version
+            server.tag = hashlib.sha1(
+                (server.settings + repr(version)).encode('utf-8')).hexdigest()
+        return server.tag
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_body = True
+        self.route()
+
+    def do_HEAD(self):
+        self.send_body = False
+        self.route()
+
+    def route(self):
+        parsed = urlparse(self.path)
+        path = unquote(parsed.path).lstrip('/')
+        parts = path.split('/')
+
+        if path in ('', 'rendered.html'):
+            return self.send_page(self.index_page)
+        if path == 'messages.html':
+            return self.send_page(self.window_page, parse_qs(parsed.query))
+        match = MONTH_PAGE.match(path)
+        if match:
+            return self.send_page(self.month_page, *map(int, match.groups()))
+        match = DAY_PAGE.match(path)
+        if match:
+            return self.send_page(self.day_page, *map(int, match.groups()))
+        if path == 'main.css':
+            return self.send_content(self.server.pages.css().encode('utf-8'),
+                                     'text/css; charset=utf-8')
+
+        if any(part in ('', '.', '..') or part.startswith('.')
+               for part in parts):
+            return self.send_error(404)
+        if len(parts) == 2 and parts[0] == 'assets':
+            return self.send_file(os.path.join(self.server.pages.assets_dir,
+                                               parts[1]))
+        if parts[0] in MEDIA_DIRS:
+            return self.send_file(os.path.join(self.server.archive_dir,
+                                               *parts))
+        self.send_error(404)
+
+    def send_page(self, page, *args):
+        # ETags change with the archive, so a page is only rendered for an
+        # ETag that has not been seen, and only read from the archive when
+        # it is not cached
+        tag = refresh(self.server)
+        etag = '"%s"' % (hashlib.sha1(
+            (tag + self.path).encode('utf-8')).hexdigest()[:20])
+        if etag_matches(self.headers.get('If-None-Match', ''), etag):
+            return self.send_not_modified(etag)
+        body = self.server.cache.get(etag)
+        if body is None:
+            body = page(*args)
+            if body is None:
+                return self.send_error(404)
+            body = body.encode('utf-8')
+            self.server.cache.put(etag, body)
+        self.send_content(body, 'text/html; charset=utf-8',
+                          {'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    def index_page(self):
+        return self.server.pages.render_index(self.server.months)
+
+    def month_page(self, year, month):
+        server = self.server
+        months = server.months
+        if (year, month) not in months:
+            return None
+        i = months.index((year, month))
+        messages = server.source.iter_messages(
+            start_time=day_start(date(year, month, 1), server.timezone),
+            end_time=day_start(date(*next_month(year, month), 1),
+                               server.timezone))
+        nav = {
+            'label': datetime(year, month, 1).strftime('%B %Y'),
+            'index': 'rendered.html',
+            'prev': 'rendered-%04d-%02d.html' % months[i - 1] if i > 0
+            else None,
+            'next': 'rendered-%04d-%02d.html' % months[i + 1]
+            if i + 1 < len(months) else None
+        }
+        return server.pages.render_page(messages, nav)
+
+    def day_page(self, year, month, day):
+        server = self.server
+        if (year, month) not in server.months:
+            return None
+        try:
+            page_day = date(year, month, day)
+        except ValueError:
+            return None
+        following = page_day + timedelta(days=1)
+        messages = server.source.iter_messages(
+            start_time=day_start(page_day, server.timezone),
+            end_time=day_start(following, server.timezone))
+        nav = {'label': page_day.strftime('%b %d, %Y'),
+               'index': 'rendered-%04d-%02d.html' % (year, month)}
+        for key, other in (('prev', page_day - timedelta(days=1)),
+                           ('next', following)):
+            if (other.year, other.month) in server.months:
+                nav[key] = 'rendered-%s.html' % (other.isoformat())
+        return server.pages.render_page(messages, nav)
+
+    def window_page(self, query):
+        # Up to window_size messages after or before a message id
+        server = self.server
+        try:
+            after_id = int(query['after'][0]) if 'after' in query else None
+            before_id = int(query['before'][0]) if 'before' in query \
+                else None
+        except ValueError:
+            return None
+
+        if before_id is not None:
+            messages = server.source.iter_messages(last_id=before_id - 1,
+                                                   reverse=True)
+        else:
+            messages = server.source.iter_messages(
+                first_id=None if after_id is None else after_id + 1)
+        messages = list(islice((message for message in messages
+                                if message.id is not None),
+                               server.window_size))
+        if before_id is not None:
+            messages.reverse()
+
+        nav = {'label': 'Messages', 'index': 'rendered.html'}
+        if messages:
+            first_id, last_id = server.source.id_bounds()
+            nav['label'] = 'Messages %s - %s' % (
+                local_date(messages[0].created_at, server.timezone),
+                local_date(messages[-1].created_at, server.timezone))
+            if int(messages[0].id) > first_id:
+                nav['prev'] = 'messages.html?before=%s' % (messages[0].id)
+            if int(messages[-1].id) < last_id:
+                nav['next'] = 'messages.html?after=%s' % (messages[-1].id)
+        return server.pages.render_page(messages, nav)
+
+    def send_not_modified(self, etag, headers=None):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def send_content(self, body, mime_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.send_body:
+            self.wfile.write(body)
+
+    def send_file(self, path):
+        # Media is sent in byte ranges when asked, which browsers need to
+        # seek in videos
+        try:
+            fp = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return self.send_error(404)
+        with fp:
+            stat = os.fstat(fp.fileno())
+            size = stat.st_size
+            etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+            last_modified = email.utils.formatdate(stat.st_mtime,
+                                                   usegmt=True)
+            headers = {'ETag': etag, 'Last-Modified': last_modified,
+                       'Accept-Ranges': 'bytes'}
+
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match is not None:
+                if etag_matches(if_none_match, etag):
+                    return self.send_not_modified(etag, headers)
+            elif self.headers.get('If-Modified-Since') == last_modified:
+                return self.send_not_modified(etag, headers)
+
+            byte_range = None
+            if 'Range' in self.headers and \
+               self.headers.get('If-Range') in (None, etag, last_modified):
+                byte_range = parse_range(self.headers['Range'], size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % (size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            first, last = byte_range or (0, size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-Type', content_type(path))
+            self.send_header('Content-Length', str(last - first + 1))
+            if byte_range:
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            if not self.send_body:
+                return
+
+            fp.seek(first)
+            remaining = last - first + 1
+            try:
+                while remaining > 0:
+                    data = fp.read(min(COPY_SIZE, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # Browsers drop video requests once they have enough
+                self.close_connection = True
+
+
+def make_server(archive_dir, pages, settings='', timezone=None,
+                host='127.0.0.1', port=8000, cache_size=CACHE_SIZE,
+                window_size=WINDOW_SIZE):
+    # pages renders the HTML (see render_chat.ServedPages); cache_size is
+    # in megabytes
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.archive_dir = archive_dir
+    server.pages = pages
+    server.settings = settings
+    server.timezone = timezone
+    server.window_size = window_size
+    server.source = ArchiveSource(archive_dir)
+    server.cache = PageCache(cache_size * 1024 * 1024)
+    server.lock = threading.Lock()
+    server.version = None
+    server.tag = None
+    server.months = []
+    return server
@@ -0,0 +1,182 @@
+import sqlite3
+from itertools import islice
+
+import json_codec
+import message_store
+
+SQLITE_FILE = "archive.sqlite"
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    author TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (author);
+CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    message_id INTEGER NOT NULL REFERENCES messages (id),
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    url TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (message_id, position)
+);
+CREATE INDEX IF NOT EXISTS attachments_type ON attachments (type);
+
+CREATE TABLE IF NOT EXISTS favorites (
+    message_id INTEGER NOT NULL REFERENCES messages (id),
+    position INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (message_id, position)
+);
+CREATE INDEX IF NOT EXISTS favorites_user_id ON favorites (user_id);
+
+CREATE TABLE IF NOT EXISTS mentions (
+    message_id INTEGER NOT NULL REFERENCES messages (id),
+    user_id TEXT NOT NULL,
+    start INTEGER,
+    length INTEGER
+);
+CREATE INDEX IF NOT EXISTS mentions_message_id ON mentions (message_id);
+CREATE INDEX IF NOT EXISTS mentions_user_id ON mentions (user_id);
+
+CREATE TABLE IF NOT EXISTS people (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    avatar_url TEXT
+);
+
+CREATE TABLE IF NOT EXISTS group_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+MESSAGE_ORDER = "ORDER BY m.created_at, m.id"
+
+
+class SqliteArchive(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def count_messages(self):
+        return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def clear_messages(self):
+        with self.db:
+            for table in ('mentions', 'favorites', 'attachments', 'messages'):
+                self.db.execute("DELETE FROM %s" % (table))
+
+    def add_messages(self, messages):
+        # Each batch is written in its own transaction, so a page of
+        # messages is either fully in the database or not at all
+        messages = iter(messages)
+        while True:
+            batch = list(islice(messages, BATCH_SIZE))
+            if not batch:
+                break
+            with self.db:
+                self.insert_messages(batch)
+
+    def insert_messages(self, messages):
+        ids = [(int(m.id),) for m in messages]
+        for table in ('mentions', 'favorites', 'attachments'):
+            self.db.executemany("DELETE FROM %s WHERE message_id = ?" % (
+                table), ids)
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+            [(int(m.id), m.author, m.created_at, m.text)
+             for m in messages])
+        self.db.executemany(
+            "INSERT INTO attachments VALUES (?, ?, ?, ?, ?)",
+            [(int(m.id), i, att['type'], att.get('url'),
+              json_codec.dumps(att))
+             for m in messages for i, att in enumerate(m.attachments)])
+        self.db.executemany(
+            "INSERT INTO favorites VALUES (?, ?, ?)",
+            [(int(m.id), i, user_id)
+             for m in messages
+             for i, user_id in enumerate(m.favorited_by)])
+        self.db.executemany(
+            "INSERT INTO mentions VALUES (?, ?, ?, ?)",
+            [(int(m.id), user_id, locus[0], locus[1])
+             for m in messages for att in m.attachments
+             if att['type'] == 'mentions'
+             for user_id, locus in zip(att.get('user_ids', []),
+                                       att.get('loci', []))])
+
+    def save_people(self, people):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO people VALUES (?, ?, ?)",
+                [(k, v['name'], v['avatar_url']) for k, v in people.items()])
+
+    def save_group_info(self, group_info):
+        with self.db:
+            self.db.execute("DELETE FROM group_info")
+            self.db.executemany(
+                "INSERT INTO group_info VALUES (?, ?)",
+                [(k, json_codec.dumps(v))
+                 for k, v in group_info.items()])
+
+    def load_people(self):
+        return {row[0]: {'name': row[1], 'avatar_url': row[2]}
+                for row in self.db.execute("SELECT * FROM people")}
+
+    def load_group_info(self):
+        return {row[0]: json_codec.loads(row[1])
+                for row in self.db.execute("SELECT * FROM group_info")}
+
+    def iter_messages(self):
+        # Attachments and favorites are read with cursors in the same order
+        # as the messages and merged in, instead of one query per message
+        attachments = grouped_rows(self.db.execute(
+            "SELECT a.message_id, a.data FROM attachments a "
+            "JOIN messages m ON m.id = a.message_id "
+            "%s, a.position" % (MESSAGE_ORDER)))
+        favorites = grouped_rows(self.db.execute(
+            "SELECT f.message_id, f.user_id FROM favorites f "
+            "JOIN messages m ON m.id = f.message_id "
+            "%s, f.position" % (MESSAGE_ORDER)))
+        next_attachments = next(attachments, None)
+        next_favorites = next(favorites, None)
+
+        for message_id, author, created_at, text in self.db.execute(
+                "SELECT m.id, m.author, m.created_at, m.text "
+                "FROM messages m %s" % (MESSAGE_ORDER)):
+            favorited_by = message_store.NO_ITEMS
+            message_attachments = message_store.NO_ITEMS
+            if next_favorites and next_favorites[0] == message_id:
+                favorited_by = next_favorites[1]
+                next_favorites = next(favorites, None)
+            if next_attachments and next_attachments[0] == message_id:
+                message_attachments = [json_codec.loads(data) for data in
+                                       next_attachments[1]]
+                next_attachments = next(attachments, None)
+            yield message_store.Message(str(message_id), author, created_at,
+                                        text, favorited_by,
+                                        message_attachments)
+
+
+def grouped_rows(rows):
+    # Yields (message id, [values]) for consecutive rows of each message
+    message_id = None
+    values = []
+    for row_message_id, value in rows:
+        if row_message_id != message_id:
+            if values:
+                yield message_id, values
+            message_id = row_message_id
+            values = []
+        values.append(value)
+    if values:
+        yield message_id, values
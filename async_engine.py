@@ -0,0 +1,211 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+
+import aiohttp
+from tqdm import tqdm
+
+import json_codec
+import run_metrics
+
+from downloader import CHUNK_SIZE, REQUEST_TIMEOUT, link_cached, \
+    part_path_for
+from http_retry import RETRY_STATUSES, RetryPolicy, parse_retry_after
+
+# Listing pages requested at once once a listing is known to span several
+LISTING_WINDOW = 4
+LISTING_PAGE_SIZE = 10
+
+
+class AsyncEngine(object):
+    # Runs listing and media requests on a single event loop in a
+    # background thread. submit(), wait_all() and fetch_all() match
+    # MediaDownloader so it can be used in its place, including from
+    # several archiving threads at once.
+    def __init__(self, num_workers=8, host_limit=4, api=None,
+                 retry_policy=None, media_store=None):
+        self.media_store = media_store
+        self.num_workers = num_workers
+        self.host_limit = host_limit
+        self.api = api
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self.lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.downloaded_urls = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.session = self.run(self.create_session())
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.num_workers,
+                                         limit_per_host=self.host_limit)
+        self.download_slots = asyncio.Semaphore(self.num_workers)
+        self.api_slots = asyncio.Semaphore(
+            self.api.max_in_flight if self.api else 4)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def call(self, retry_policy, attempt):
+        # Same retry rules as RetryPolicy.call, without blocking the loop
+        stats = retry_policy.stats
+        num_retry = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = await attempt()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                stats.record_request('error', time.perf_counter() - start)
+                if num_retry >= retry_policy.max_retries:
+                    raise
+                delay = retry_policy.backoff(num_retry)
+            else:
+                stats.record_request(response.status,
+                                     time.perf_counter() - start)
+                if response.status not in RETRY_STATUSES or \
+                   num_retry >= retry_policy.max_retries:
+                    return response
+                delay = parse_retry_after(response)
+                if delay is None:
+                    delay = retry_policy.backoff(num_retry)
+
+            stats.record_retry(delay)
+            await asyncio.sleep(delay)
+            num_retry += 1
+
+    async def api_get(self, url, params):
+        result = {}
+
+        async def attempt():
+            async with self.api_slots:
+                if self.api and self.api.bucket:
+                    waited = await self.loop.run_in_executor(
+                        None, self.api.bucket.acquire)
+                    self.api.stats.record_throttle(waited)
+                async with self.session.get(url, params=params) as r:
+                    result['body'] = await r.read()
+                    return r
+
+        retry_policy = self.api.retry_policy if self.api else \
+            self.retry_policy
+        (await self.call(retry_policy, attempt)).raise_for_status()
+        retry_policy.stats.record_bytes(len(result['body']))
+        return json_codec.loads(result['body'])
+
+    async def list_pages(self, url, params):
+        # The first page tells whether the listing spans several pages, in
+        # which case the following pages are requested a window at a time
+        # until a short page marks the end
+        params = dict(params, per_page=LISTING_PAGE_SIZE)
+        chats = []
+        page_num = 1
+        window = 1
+        while True:
+            pages = await asyncio.gather(*[
+                self.api_get(url, dict(params, page=page_num + i))
+                for i in range(window)])
+            for page in pages:
+                chats += page['response']
+                if len(page['response']) < LISTING_PAGE_SIZE:
+                    return chats
+            page_num += window
+            window = LISTING_WINDOW
+
+    def list_chats(self, url, params):
+        return self.run(self.list_pages(url, params))
+
+    async def fetch(self, url, base_path):
+        with self.lock:
+            cached_path = self.downloaded_urls.get(url)
+        if cached_path is None and self.media_store is not None:
+            cached_path = self.media_store.lookup(url)
+        if cached_path is not None and os.path.exists(cached_path):
+            run_metrics.metrics.count('cached_files')
+            return link_cached(cached_path, base_path), 0
+
+        result = {}
+
+        async def attempt():
+            async with self.download_slots:
+                async with self.session.get(url) as r:
+                    if r.status in RETRY_STATUSES:
+                        return r
+                    r.raise_for_status()
+                    img_type = r.headers['content-type'].split('/')[1]
+                    result['path'] = '%s.%s' % (base_path, img_type)
+                    part_path = part_path_for(result['path'])
+                    result['size'] = 0
+                    with open(part_path, 'wb') as fp:
+                        async for chunk in r.content.iter_chunked(
+                                CHUNK_SIZE):
+                            fp.write(chunk)
+                            result['size'] += len(chunk)
+                    os.replace(part_path, result['path'])
+                    return r
+
+        (await self.call(self.retry_policy, attempt)).raise_for_status()
+        self.retry_policy.stats.record_bytes(result['size'])
+
+        with self.lock:
+            self.bytes_downloaded += result['size']
+            self.downloaded_urls[url] = result['path']
+        if self.media_store is not None:
+            self.media_store.add(url, result['path'])
+        return result['path'], result['size']
+
+    async def fetch_job(self, url, base_path):
+        try:
+            return await self.fetch(url, base_path)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError,
+                KeyError) as e:
+            return e
+
+    def submit(self, url, base_path):
+        # Starts a download on the loop, recorded under the caller's phase
+        return asyncio.run_coroutine_threadsafe(
+            self.fetch_job(url, base_path), self.loop)
+
+    def wait_all(self, futures, progress=True):
+        # Waits for downloads started with submit(), given as a dict of
+        # future: (url, base path)
+        downloaded = {}
+        failed = []
+        num_bytes = 0
+        start_time = time.time()
+
+        pbar = tqdm(total=len(futures), disable=not progress)
+        for future in as_completed(futures):
+            url, base_path = futures[future]
+            result = future.result()
+            if isinstance(result, Exception):
+                failed.append(url)
+                tqdm.write("Failed to fetch %s: %s" % (url, result))
+            else:
+                downloaded[base_path], size = result
+                num_bytes += size
+
+            elapsed = max(time.time() - start_time, 1e-6)
+            pbar.set_postfix_str('%sB/s' % (
+                tqdm.format_sizeof(num_bytes / elapsed)))
+            pbar.update(1)
+        pbar.close()
+
+        return downloaded, failed, num_bytes
+
+    def fetch_all(self, jobs, progress=True):
+        return self.wait_all({self.submit(url, base_path): (url, base_path)
+                              for url, base_path in jobs}, progress)
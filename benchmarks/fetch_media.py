@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from downloader import MediaDownloader  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Download every url in
+        a file with the archiver's media downloader.
+        """)
+    parser.add_argument('--urls-file', dest='urls_file', required=True)
+    parser.add_argument('--output-dir', '-o', dest='output_dir',
+                        required=True)
+    parser.add_argument('--download-workers', default=8, type=int,
+                        dest='download_workers')
+    parser.add_argument('--download-host-limit', default=4, type=int,
+                        dest='download_host_limit')
+    args = parser.parse_args()
+
+    with open(args.urls_file) as fp:
+        urls = [line.strip() for line in fp if line.strip()]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    downloader = MediaDownloader(args.download_workers,
+                                 args.download_host_limit)
+    _, failed, num_bytes = downloader.fetch_all(
+        [(url, os.path.join(args.output_dir, str(i)))
+         for i, url in enumerate(urls)], progress=False)
+    downloader.close()
+
+    print("Downloaded %d bytes, %d failed" % (num_bytes, len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Message i of a chat has id ID_BASE + i * ID_STEP and is MESSAGE_INTERVAL
+# seconds after message i - 1, so any page can be generated on demand
+# without keeping the chat in memory
+ID_BASE = 150000000000000000
+ID_STEP = 7
+START_TS = 1400000000
+MESSAGE_INTERVAL = 120
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+class Chat(object):
+    def __init__(self, chat_id, name, num_messages, members, seed):
+        self.id = chat_id
+        self.name = name
+        self.num_messages = num_messages
+        self.members = members
+        self.seed = seed
+
+    def message_id(self, i):
+        return str(ID_BASE + i * ID_STEP)
+
+    def index_of(self, message_id):
+        # Of the last message with an id up to message_id, which need not
+        # be the id of a message
+        return (int(message_id) - ID_BASE) // ID_STEP
+
+    def index_from(self, message_id):
+        # Of the first message with an id from message_id on
+        return -((ID_BASE - int(message_id)) // ID_STEP)
+
+    def message(self, i, base_url, image_rate, video_rate):
+        rng = random.Random(self.seed * 1000003 + i)
+        sender = self.members[rng.randrange(len(self.members))]
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+        attachments = []
+        r = rng.random()
+        if r < image_rate:
+            attachments.append({'type': 'image', 'url': '%s/img/%x' % (
+                base_url, rng.getrandbits(64))})
+        elif r < image_rate + video_rate:
+            url = '%s/vid/%x.mp4' % (base_url, rng.getrandbits(64))
+            attachments.append({'type': 'video', 'url': url})
+            text = text + ' ' + url
+        elif r < image_rate + video_rate + 0.02:
+            other = self.members[rng.randrange(len(self.members))]
+            attachments.append({'type': 'mentions', 'user_ids': [other[0]],
+                                'loci': [[0, min(3, len(text))]]})
+        favorites = [m[0] for m in self.members if rng.random() < 0.05]
+        return {
+            'id': self.message_id(i),
+            'sender_id': sender[0],
+            'user_id': sender[0],
+            'name': sender[1],
+            'avatar_url': '%s/img/avatar%s' % (base_url, sender[0]),
+            'created_at': START_TS + i * MESSAGE_INTERVAL,
+            'text': text,
+            'favorited_by': favorites,
+            'attachments': attachments,
+            'system': False,
+        }
+
+
+def make_chats(num_groups, num_dms, messages_per_chat, members_per_group):
+    people = [(str(1000 + i), 'Person %d' % i)
+              for i in range(max(members_per_group + num_groups, num_dms))]
+    me = ('999', 'Me')
+    groups = {}
+    for g in range(num_groups):
+        members = [me] + people[g:g + members_per_group]
+        chat_id = str(40000000 + g)
+        groups[chat_id] = Chat(chat_id, 'Group %d' % g, messages_per_chat,
+                               members, g + 1)
+    dms = {}
+    for d in range(num_dms):
+        other = people[d]
+        dms[other[0]] = Chat(other[0], other[1], messages_per_chat,
+                             [me, other], 10000 + d)
+    return groups, dms
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which would otherwise wait
+    # on delayed ACKs with keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def page_of_messages(self, chat, query, base_url):
+        # Same paging rules as the GroupMe API: newest first, except for
+        # after_id which pages forwards
+        server = self.server
+        limit = min(int(query.get('limit', ['20'])[0]), server.page_size)
+        n = chat.num_messages
+        if 'after_id' in query:
+            start = max(chat.index_of(query['after_id'][0]) + 1, 0)
+            idx = range(start, min(start + limit, n))
+        elif 'since_id' in query:
+            lo = chat.index_of(query['since_id'][0]) + 1
+            idx = range(n - 1, max(lo, n - limit) - 1, -1)
+        elif 'before_id' in query:
+            end = min(chat.index_from(query['before_id'][0]), n)
+            idx = range(end - 1, max(end - limit, 0) - 1, -1)
+        else:
+            idx = range(n - 1, max(n - limit, 0) - 1, -1)
+        return [chat.message(i, base_url, server.image_rate,
+                             server.video_rate) for i in idx]
+
+    def send_media(self, kind, name):
+        size = self.server.media_size
+        body = (name.encode('utf-8') * (size // max(len(name), 1) + 1))[:size]
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'video/mp4' if kind == 'vid' else 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.rng.random() < server.error_rate:
+            if server.rng.random() < 0.5:
+                return self.send_empty(429, {'Retry-After': '0'})
+            return self.send_empty(503)
+
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = [p for p in parsed.path.split('/') if p]
+        base_url = 'http://%s:%d' % self.server.server_address[:2]
+
+        if len(parts) == 2 and parts[0] in ('img', 'vid'):
+            return self.send_media(parts[0], parts[1])
+
+        if parts[:1] != ['v3']:
+            return self.send_empty(404)
+        parts = parts[1:]
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['10'])[0])
+
+        if parts == ['groups']:
+            chats = list(server.groups.values())
+            chats = chats[(page - 1) * per_page:page * per_page]
+            return self.send_json({'response': [{
+                'id': c.id, 'name': c.name,
+                'messages': {'count': c.num_messages}} for c in chats]})
+        if parts == ['chats']:
+            chats = list(server.dms.values())
+            chats = chats[(page - 1) * per_page:page * per_page]
+            return self.send_json({'response': [{
+                'other_user': {'id': c.id, 'name': c.name},
+                'messages_count': c.num_messages} for c in chats]})
+        if len(parts) == 2 and parts[0] == 'groups':
+            chat = server.groups.get(parts[1])
+            if chat is None:
+                return self.send_empty(404)
+            return self.send_json({'response': {
+                'name': chat.name, 'description': 'Synthetic group',
+                'image_url': None, 'created_at': START_TS,
+                'members': [{
+                    'user_id': uid, 'nickname': name,
+                    'image_url': '%s/img/avatar%s' % (base_url, uid)}
+                    for uid, name in chat.members]}})
+        if len(parts) == 3 and parts[0] == 'groups' and \
+           parts[2] == 'messages':
+            chat = server.groups.get(parts[1])
+            if chat is None:
+                return self.send_empty(404)
+            messages = self.page_of_messages(chat, query, base_url)
+            if not messages:
+                return self.send_empty(304)
+            return self.send_json({'response': {
+                'count': chat.num_messages, 'messages': messages}})
+        if parts == ['direct_messages']:
+            chat = server.dms.get(query.get('other_user_id', [''])[0])
+            if chat is None:
+                return self.send_empty(404)
+            # Direct messages can only be paged backwards
+            query.pop('after_id', None)
+            messages = self.page_of_messages(chat, query, base_url)
+            if not messages:
+                return self.send_empty(304)
+            return self.send_json({'response': {
+                'count': chat.num_messages, 'direct_messages': messages}})
+        return self.send_empty(404)
+
+
+def make_server(host='127.0.0.1', port=0, num_groups=3, num_dms=2,
+                messages_per_chat=1000, members_per_group=10, page_size=100,
+                latency=0.0, error_rate=0.0, image_rate=0.05,
+                video_rate=0.01, media_size=4096, seed=0):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.groups, server.dms = make_chats(num_groups, num_dms,
+                                           messages_per_chat,
+                                           members_per_group)
+    server.page_size = page_size
+    server.latency = latency
+    server.error_rate = error_rate
+    server.image_rate = image_rate
+    server.video_rate = video_rate
+    server.media_size = media_size
+    server.rng = random.Random(seed)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""A stand-in for the
+        GroupMe API serving synthetic chats, for e.g.
+        archive_chat.py --api-url http://127.0.0.1:8765/v3
+        """)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--groups', type=int, default=3,
+                        help="Number of group chats")
+    parser.add_argument('--dms', type=int, default=2,
+                        help="Number of direct message chats")
+    parser.add_argument('--messages', type=int, default=1000,
+                        help="Number of messages in each chat")
+    parser.add_argument('--members', type=int, default=10,
+                        help="Number of members in each group")
+    parser.add_argument('--page-size', type=int, default=100,
+                        dest='page_size',
+                        help="Largest number of messages in a page")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        dest='error_rate',
+                        help="Fraction of requests answered with a 429 " +
+                             "or 503")
+    parser.add_argument('--image-rate', type=float, default=0.05,
+                        dest='image_rate',
+                        help="Fraction of messages with an image")
+    parser.add_argument('--video-rate', type=float, default=0.01,
+                        dest='video_rate',
+                        help="Fraction of messages with a video")
+    parser.add_argument('--media-size', type=int, default=4096,
+                        dest='media_size',
+                        help="Size of every image and video, in bytes")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.groups, args.dms,
+                         args.messages, args.members, args.page_size,
+                         args.latency, args.error_rate, args.image_rate,
+                         args.video_rate, args.media_size)
+    print("Serving on http://%s:%d/v3" % server.server_address[:2])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from tabulate import tabulate
+
+import mock_groupme
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+GROUP_ID = '40000000'
+DM_USER_ID = '1000'
+MEDIA_PER_MESSAGES = 100
+MEDIA_SIZE = 64 * 1024
+
+
+def run(command, log_file):
+    # Returns (seconds, peak RSS in MB) of a child process. wait4() gives
+    # the resource usage of that one child rather than of all of them.
+    start = time.perf_counter()
+    with open(log_file, 'a') as log:
+        log.write('$ %s\n' % (' '.join(command)))
+        log.flush()
+        process = subprocess.Popen(command, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    # os.waitstatus_to_exitcode() needs Python 3.9
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        raise RuntimeError("%s failed, see %s" % (command[1], log_file))
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+
+def benchmark_size(args, num_messages, work_dir):
+    server = mock_groupme.make_server(
+        num_groups=1, num_dms=1, messages_per_chat=num_messages,
+        members_per_group=args.members, page_size=args.page_size,
+        latency=args.latency, error_rate=args.error_rate, image_rate=0,
+        video_rate=0, media_size=MEDIA_SIZE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://%s:%d' % server.server_address[:2]
+    api_url = '%s/v3' % (base_url)
+
+    size_dir = os.path.join(work_dir, str(num_messages))
+    os.makedirs(size_dir, exist_ok=True)
+    log_file = os.path.join(size_dir, 'benchmark.log')
+    archive = [sys.executable, os.path.join(ROOT_DIR, 'archive_chat.py'),
+               '-t', 'benchmark', '--api-url', api_url]
+    group_dir = os.path.join(size_dir, 'group')
+
+    results = []
+
+    def record(name, amount, unit, seconds, peak_rss):
+        results.append({
+            'benchmark': name,
+            'messages': num_messages,
+            'seconds': round(seconds, 3),
+            'throughput': round(amount / seconds, 1),
+            'unit': unit,
+            'peak_rss_mb': round(peak_rss, 1)
+        })
+        print("%-16s %9d messages  %8.2fs  %10.1f %s  %7.1f MB" % (
+            name, num_messages, seconds, amount / seconds, unit, peak_rss))
+
+    seconds, peak_rss = run(archive + ['-g', GROUP_ID, '-o', group_dir],
+                            log_file)
+    record('group_messages', num_messages, 'messages/s', seconds, peak_rss)
+
+    seconds, peak_rss = run(
+        archive + ['-d', DM_USER_ID, '-o', os.path.join(size_dir, 'dm')],
+        log_file)
+    record('direct_messages', num_messages, 'messages/s', seconds, peak_rss)
+
+    num_media = max(num_messages // MEDIA_PER_MESSAGES, 1)
+    urls_file = os.path.join(size_dir, 'media_urls.txt')
+    with open(urls_file, 'w') as fp:
+        for i in range(num_media):
+            fp.write('%s/img/%x\n' % (base_url, i))
+    seconds, peak_rss = run(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, 'fetch_media.py'),
+         '--urls-file', urls_file, '-o', os.path.join(size_dir, 'media')],
+        log_file)
+    record('media_download', num_media * MEDIA_SIZE / 2 ** 20, 'MB/s',
+           seconds, peak_rss)
+
+    # CPU time spent in the main process is the part of rendering that
+    # more jobs cannot speed up
+    for jobs in args.render_jobs:
+        metrics_file = os.path.join(size_dir, 'render-%d.json' % (jobs))
+        seconds, peak_rss = run(
+            [sys.executable, os.path.join(ROOT_DIR, 'render_chat.py'),
+             '-i', group_dir, '--full-render', '-j', str(jobs),
+             '--metrics-file', metrics_file], log_file)
+        record('render' if jobs == 1 else 'render_j%d' % (jobs),
+               num_messages, 'messages/s', seconds, peak_rss)
+        with open(metrics_file) as fp:
+            cpu_seconds = json.load(fp)['cpu_seconds']
+        results[-1].update({
+            'jobs': jobs,
+            'main_cpu_seconds': cpu_seconds['process'],
+            'worker_cpu_seconds': cpu_seconds['workers']
+        })
+
+    server.shutdown()
+    server.server_close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Time archiving,
+        media downloads and rendering against a local mock of the GroupMe
+        API, recording throughput and peak memory use.
+        """)
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help="Comma separated chat sizes, in messages")
+    parser.add_argument('--members', type=int, default=20,
+                        help="Number of members in the group chat")
+    parser.add_argument('--page-size', type=int, default=100,
+                        dest='page_size',
+                        help="Largest number of messages the mock API " +
+                             "returns in a page")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the mock API adds to every response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        dest='error_rate',
+                        help="Fraction of mock API requests answered " +
+                             "with a 429 or 503")
+    parser.add_argument('--render-jobs', default='1', dest='render_jobs',
+                        help="Comma separated numbers of processes to " +
+                             "render with")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="File to save the results to")
+    parser.add_argument('--work-dir', dest='work_dir',
+                        help="Folder for the archives (default: a " +
+                             "temporary folder that is removed afterwards)")
+    args = parser.parse_args()
+    args.render_jobs = [int(jobs) for jobs in args.render_jobs.split(',')]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='groupme-bench-')
+    results = []
+    try:
+        for size in args.sizes.split(','):
+            results += benchmark_size(args, int(size), work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("")
+    print(tabulate([[r['benchmark'], r['messages'], r['seconds'],
+                     '%s %s' % (r['throughput'], r['unit']),
+                     r['peak_rss_mb']] for r in results],
+                   headers=["Benchmark", "Messages", "Seconds", "Throughput",
+                            "Peak RSS (MB)"]))
+
+    renders = [r for r in results if 'jobs' in r]
+    print("")
+    print(tabulate([[r['messages'], r['jobs'], r['seconds'],
+                     r['main_cpu_seconds'], r['worker_cpu_seconds'],
+                     round((r['main_cpu_seconds'] + r['worker_cpu_seconds']) /
+                           r['main_cpu_seconds'], 1)] for r in renders],
+                   headers=["Messages", "Jobs", "Seconds", "Main CPU (s)",
+                            "Worker CPU (s)", "Speedup limit"]))
+
+    with open(args.output, 'w') as fp:
+        json.dump({
+            'settings': {
+                'members': args.members,
+                'page_size': args.page_size,
+                'latency': args.latency,
+                'error_rate': args.error_rate,
+                'cpu_count': os.cpu_count(),
+                'python': sys.version.split()[0]
+            },
+            'results': results
+        }, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
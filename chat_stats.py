@@ -0,0 +1,325 @@
+import argparse
+from array import array
+from datetime import datetime
+import os
+import sys
+
+import pytz
+from yattag import Doc
+
+import json_codec
+import media_manifest
+import render_chat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STATS_FILE = "stats.json"
+STATS_PAGE = "stats.html"
+TOP_ATTACHMENTS = 10
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday')
+
+
+def code_of(codes, key):
+    code = codes.get(key)
+    if code is None:
+        code = codes[key] = len(codes)
+    return code
+
+
+def load_columns(messages):
+    # One pass over the messages, keeping only what the stats need as
+    # typed arrays: a row per message, a row per like and a row per
+    # attachment. People and attachment types are stored as codes.
+    people = {}
+    types = {}
+    authors = array('i')
+    created_at = array('q')
+    num_likes = array('i')
+    likers = array('i')
+    attachment_rows = array('i')
+    attachment_types = array('i')
+    attachment_urls = []
+
+    for i, message in enumerate(messages):
+        authors.append(code_of(people, message.author))
+        created_at.append(message.created_at)
+        num_likes.append(len(message.favorited_by))
+        for user_id in message.favorited_by:
+            likers.append(code_of(people, user_id))
+        for attachment in message.attachments:
+            attachment_rows.append(i)
+            attachment_types.append(code_of(types, attachment['type']))
+            attachment_urls.append(attachment.get('url'))
+
+    columns = {k: np.frombuffer(v, dtype=v.typecode) for k, v in (
+        ('authors', authors), ('created_at', created_at),
+        ('num_likes', num_likes), ('likers', likers),
+        ('attachment_rows', attachment_rows),
+        ('attachment_types', attachment_types))}
+    columns['people'] = list(people)
+    columns['types'] = list(types)
+    columns['attachment_urls'] = attachment_urls
+    return columns
+
+
+def utc_offset(timestamp, tz):
+    # Of the time render_chat.py shows, i.e. local time without a timezone
+    moment = datetime.fromtimestamp(timestamp, pytz.utc).astimezone(tz)
+    return int(moment.utcoffset().total_seconds())
+
+
+def local_times(created_at, tz=None):
+    # Offsets only change at DST transitions, so they are looked up once
+    # per day, and per message only on days that have a transition
+    days, day_rows = np.unique(created_at // 86400, return_inverse=True)
+    day_start = np.array([utc_offset(int(day) * 86400, tz) for day in days],
+                         dtype=np.int64)
+    day_end = np.array([utc_offset(int(day) * 86400 + 86399, tz)
+                        for day in days], dtype=np.int64)
+    offsets = day_start[day_rows]
+    for row in np.flatnonzero((day_start != day_end)[day_rows]):
+        offsets[row] = utc_offset(int(created_at[row]), tz)
+    return created_at + offsets
+
+
+def compute_stats(columns, people, tz=None):
+    authors = columns['authors']
+    created_at = columns['created_at']
+    num_likes = columns['num_likes']
+    attachment_rows = columns['attachment_rows']
+    num_people = len(columns['people'])
+
+    local = local_times(created_at, tz)
+    hours = local // 3600 % 24
+    # 1970-01-01 was a Thursday
+    weekdays = (local // 86400 + 3) % 7
+    months, month_counts = np.unique(
+        local.astype('datetime64[s]').astype('datetime64[M]'),
+        return_counts=True)
+
+    messages = np.bincount(authors, minlength=num_people)
+    likes_received = np.bincount(authors, weights=num_likes,
+                                 minlength=num_people).astype(np.int64)
+    likes_given = np.bincount(columns['likers'], minlength=num_people)
+    attachments = np.bincount(authors[attachment_rows],
+                              minlength=num_people)
+    members = []
+    for i in np.argsort(-messages, kind='stable'):
+        user_id = columns['people'][i]
+        members.append({
+            'id': user_id,
+            'name': people.get(user_id, {'name': user_id})['name'],
+            'messages': int(messages[i]),
+            'likes_received': int(likes_received[i]),
+            'likes_given': int(likes_given[i]),
+            'attachments': int(attachments[i]),
+        })
+
+    type_counts = np.bincount(columns['attachment_types'],
+                              minlength=len(columns['types']))
+    attachment_types = {columns['types'][i]: int(type_counts[i])
+                        for i in np.argsort(-type_counts, kind='stable')}
+
+    # Most liked attachments that are files, ties going to the earliest
+    attachment_likes = num_likes[attachment_rows]
+    has_url = np.array([url is not None for url in
+                        columns['attachment_urls']], dtype=bool)
+    top = [i for i in np.argsort(-attachment_likes, kind='stable')
+           if has_url[i]][:TOP_ATTACHMENTS]
+    top_attachments = []
+    for i in top:
+        row = attachment_rows[i]
+        user_id = columns['people'][authors[row]]
+        top_attachments.append({
+            'url': columns['attachment_urls'][i],
+            'type': columns['types'][columns['attachment_types'][i]],
+            'author': user_id,
+            'name': people.get(user_id, {'name': user_id})['name'],
+            'created_at': int(created_at[row]),
+            'likes': int(attachment_likes[i]),
+        })
+
+    return {
+        'totals': {
+            'messages': int(len(created_at)),
+            'likes': int(num_likes.sum()),
+            'attachments': int(len(attachment_rows)),
+            'people': num_people,
+            'first_message': int(created_at.min()) if len(created_at)
+            else None,
+            'last_message': int(created_at.max()) if len(created_at)
+            else None,
+        },
+        'members': members,
+        'by_hour': np.bincount(hours, minlength=24).tolist(),
+        'by_weekday': np.bincount(weekdays, minlength=7).tolist(),
+        'by_weekday_hour': np.bincount(weekdays * 24 + hours,
+                                       minlength=7 * 24).reshape(
+                                           7, 24).tolist(),
+        'by_month': {str(month): int(count)
+                     for month, count in zip(months, month_counts)},
+        'attachment_types': attachment_types,
+        'top_attachments': top_attachments,
+    }
+
+
+def stats_css():
+    return """
+    .stats table { border-collapse: collapse; margin-bottom: 20px; }
+    .stats td, .stats th { padding: 2px 10px; text-align: left; }
+    .stats td.count { text-align: right; }
+    .stats .bar { background: #00aff0; height: 12px; }
+    """
+
+
+def render_counts(page_elements, title, counts):
+    # A table of label, count and a bar as wide as the count's share of the
+    # largest one
+    doc, tag, text = page_elements
+    largest = max([count for _, count in counts] + [1])
+    with tag('h2'):
+        text(title)
+    with tag('table'):
+        for label, count in counts:
+            with tag('tr'):
+                with tag('td'):
+                    text(label)
+                with tag('td', klass='count'):
+                    text(str(count))
+                with tag('td'):
+                    with tag('div', klass='bar',
+                             style='width: %dpx' % (300 * count // largest)):
+                        pass
+
+
+def render_stats_page(group_info, stats, media, timezone=None):
+    page_elements = Doc().tagtext()
+    doc, tag, text = page_elements
+
+    def date(timestamp):
+        return datetime.fromtimestamp(timestamp, timezone).strftime(
+            '%b %d, %Y')
+
+    with tag('html'):
+        with tag('head'):
+            doc.asis('<meta charset="utf-8">')
+            doc.asis('<link href="%s" rel="stylesheet">' % (
+                render_chat.FONT_URL))
+            doc.asis('<link rel="stylesheet" href="main.css">')
+            with tag('style'):
+                doc.asis(stats_css())
+            with tag('title'):
+                text('GroupMe archive - %s - Stats' % (group_info['name']))
+        with tag('body'):
+            with tag('div', id='container', klass='stats'):
+                with tag('h1'):
+                    text(group_info['name'])
+                totals = stats['totals']
+                with tag('p'):
+                    text('%d messages, %d likes and %d attachments from '
+                         '%d people' % (totals['messages'], totals['likes'],
+                                        totals['attachments'],
+                                        totals['people']))
+                    if totals['messages']:
+                        text(', %s - %s' % (date(totals['first_message']),
+                                            date(totals['last_message'])))
+
+                with tag('h2'):
+                    text('Members')
+                with tag('table'):
+                    with tag('tr'):
+                        for heading in ('Name', 'Messages', 'Likes received',
+                                        'Likes given', 'Attachments'):
+                            with tag('th'):
+                                text(heading)
+                    for member in stats['members']:
+                        with tag('tr'):
+                            with tag('td'):
+                                text(member['name'])
+                            for key in ('messages', 'likes_received',
+                                        'likes_given', 'attachments'):
+                                with tag('td', klass='count'):
+                                    text(str(member[key]))
+
+                render_counts(page_elements, 'By hour', [
+                    ('%02d:00' % (hour), count)
+                    for hour, count in enumerate(stats['by_hour'])])
+                render_counts(page_elements, 'By weekday',
+                              list(zip(WEEKDAYS, stats['by_weekday'])))
+                render_counts(page_elements, 'By month',
+                              list(stats['by_month'].items()))
+                render_counts(page_elements, 'Attachment types',
+                              list(stats['attachment_types'].items()))
+
+                with tag('h2'):
+                    text('Most liked attachments')
+                with tag('table'):
+                    for attachment in stats['top_attachments']:
+                        # The archived file when there is one
+                        key = media_manifest.attachment_key(
+                            attachment['url'])
+                        href = media['attachments'].get(key,
+                                                        attachment['url'])
+                        with tag('tr'):
+                            with tag('td'):
+                                with tag('a', href=href):
+                                    text(attachment['type'])
+                            with tag('td'):
+                                text(attachment['name'])
+                            with tag('td'):
+                                text(date(attachment['created_at']))
+                            with tag('td', klass='count'):
+                                text('%d likes' % (attachment['likes']))
+
+    return doc.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Work out per-member
+        message and like counts, activity by hour, weekday and month, and
+        the most liked attachments of an archive, saved as stats.json and
+        a stats.html summary page. Needs numpy.
+        """)
+    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
+    parser.add_argument('--timezone', type=str,
+                        help="Timezone to count hours and days in.")
+    parser.add_argument('--sqlite', action='store_true',
+                        help="Read the archive from archive.sqlite " +
+                             "instead of the JSON files.")
+
+    args = parser.parse_args()
+
+    if np is None:
+        print("chat_stats.py requires the numpy package")
+        sys.exit(1)
+
+    db, people, messages, group_info = render_chat.load_archive(
+        args.input_dir, args.sqlite)
+    media = media_manifest.load_manifest(args.input_dir)
+
+    tz = None
+    if args.timezone:
+        tz = pytz.timezone(args.timezone)
+
+    columns = load_columns(messages)
+    if db is not None:
+        db.close()
+    stats = compute_stats(columns, people, tz)
+
+    with open(os.path.join(args.input_dir, STATS_FILE), 'w',
+              encoding='utf-8') as fp:
+        json_codec.dump(stats, fp, indent=2)
+    with open(os.path.join(args.input_dir, STATS_PAGE), 'w',
+              encoding='utf-8') as fp:
+        fp.write(render_stats_page(group_info, stats, media, tz))
+
+    print("Saved stats of %d messages" % (stats['totals']['messages']))
+
+
+if __name__ == '__main__':
+    main()
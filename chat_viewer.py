@@ -0,0 +1,376 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import media_manifest
+
+VIEWER_DIR = "viewer"
+VIEWER_CHUNK_SIZE = 200
+# Days with more messages than this are split across chunks
+VIEWER_MAX_CHUNK_SIZE = 1000
+
+# Messages are kept as compact arrays in the data files:
+# [author, created_at, text, likes, media, mentions, new day]
+# where author and likes index into the people list, media entries are
+# [kind, path, thumbnail or poster] and trailing empty fields are left out
+VIEWER_JS = r"""(function () {
+    var BASE = 'viewer/';
+    var ESTIMATED_HEIGHT = 60;
+    var loaded = {};
+    var waiting = {};
+    var meta = null;
+    var formatter = null;
+
+    function load(name, callback) {
+        if (name in loaded) {
+            callback(loaded[name]);
+            return;
+        }
+        if (waiting[name]) {
+            waiting[name].push(callback);
+            return;
+        }
+        waiting[name] = [callback];
+        var script = document.createElement('script');
+        script.src = BASE + name + '.js';
+        script.onload = function () { script.remove(); };
+        document.head.appendChild(script);
+    }
+
+    window.groupmeViewerLoaded = function (name, data) {
+        loaded[name] = data;
+        var callbacks = waiting[name] || [];
+        delete waiting[name];
+        callbacks.forEach(function (callback) { callback(data); });
+    };
+
+    function element(tag, className, text) {
+        var node = document.createElement(tag);
+        if (className) {
+            node.className = className;
+        }
+        if (text !== undefined) {
+            node.textContent = text;
+        }
+        return node;
+    }
+
+    function formatTime(timestamp) {
+        // Same format as the static pages: Jan 02, 2006 at 3:04 PM
+        var parts = {};
+        formatter.formatToParts(new Date(timestamp * 1000)).forEach(
+            function (part) { parts[part.type] = part.value; });
+        return parts.month + ' ' + parts.day + ', ' + parts.year + ' at ' +
+            parts.hour + ':' + parts.minute + ' ' +
+            parts.dayPeriod.toUpperCase();
+    }
+
+    function renderAvatar(person) {
+        var avatar = element('div', 'avatar');
+        if (person[1]) {
+            var img = element('img');
+            img.src = person[1];
+            avatar.appendChild(img);
+        } else {
+            var names = person[0].split(/\s+/).filter(Boolean);
+            var shorthand = names.length ? names[0][0].toUpperCase() : '';
+            if (names.length > 1) {
+                shorthand += names[names.length - 1][0].toUpperCase();
+            }
+            avatar.textContent = shorthand;
+        }
+        return avatar;
+    }
+
+    function renderText(text, mentions) {
+        var span = element('span', 'message');
+        var prevEnd = 0;
+        var parts = [];
+        mentions.forEach(function (locus) {
+            parts.push([text.slice(prevEnd, locus[0]), 'normal']);
+            parts.push([text.slice(locus[0], locus[0] + locus[1]), 'bold']);
+            prevEnd = locus[0] + locus[1];
+        });
+        parts.push([text.slice(prevEnd), 'normal']);
+        parts.forEach(function (part) {
+            var node = element('span', null, part[0]);
+            node.style.fontWeight = part[1];
+            span.appendChild(node);
+        });
+        return span;
+    }
+
+    function renderMedia(media) {
+        var span = element('span', 'message');
+        var node;
+        if (media[0] === 'v') {
+            node = element('video');
+            node.src = media[1];
+            node.controls = true;
+            node.preload = 'none';
+            if (media[2]) {
+                node.poster = media[2];
+            }
+            span.appendChild(node);
+        } else {
+            node = element('img');
+            node.loading = 'lazy';
+            node.src = media[2] || media[1];
+            if (media[2]) {
+                var link = element('a');
+                link.href = media[1];
+                link.appendChild(node);
+                node = link;
+            }
+            span.appendChild(node);
+        }
+        return span;
+    }
+
+    function renderLikes(likes) {
+        var span = element('span', 'likes');
+        var heart = element('img');
+        heart.src = likes.length ? 'assets/heart-full.png'
+            : 'assets/heart.png';
+        span.appendChild(heart);
+        if (likes.length) {
+            span.className = 'likes tooltip';
+            span.appendChild(document.createTextNode(likes.length));
+            // Tooltips are only built once they are needed
+            span.addEventListener('mouseenter', function () {
+                var tooltip = element('div', 'tooltiptext');
+                likes.forEach(function (id) {
+                    var name = meta.people[id][0];
+                    tooltip.appendChild(element('div', null, name));
+                });
+                span.appendChild(tooltip);
+            }, {once: true});
+        }
+        return span;
+    }
+
+    function renderMessage(message) {
+        var person = meta.people[message[0]];
+        var title = formatTime(message[1]);
+        var fragment = document.createDocumentFragment();
+        var container;
+
+        if (message[6]) {
+            container = element('div', 'message_container');
+            container.style.backgroundColor = '#e4e4e4';
+            container.appendChild(element('span', 'system_message', title));
+            fragment.appendChild(container);
+        }
+
+        container = element('div', 'message_container');
+        container.title = title;
+        if (person[2]) {
+            container.style.backgroundColor = '#e4e4e4';
+            container.appendChild(element('span', 'system_message',
+                                          message[2] || '<ATTACHMENT>'));
+            fragment.appendChild(container);
+            return fragment;
+        }
+
+        var box = element('div', 'message_box');
+        box.appendChild(element('span', 'user', person[0]));
+        (message[4] || []).forEach(function (media) {
+            box.appendChild(renderMedia(media));
+        });
+        if (message[2]) {
+            box.appendChild(renderText(message[2], message[5] || []));
+        }
+        container.appendChild(renderAvatar(person));
+        container.appendChild(box);
+        container.appendChild(renderLikes(message[3] || []));
+        fragment.appendChild(container);
+        return fragment;
+    }
+
+    // Chunks start out as empty blocks of an estimated height. They are
+    // filled in as they come near the window, and emptied again, keeping
+    // their measured height, once they are far from it.
+    function mount(block) {
+        block.wanted = true;
+        load('chunk-' + block.index, function (messages) {
+            if (!block.wanted || block.mounted) {
+                return;
+            }
+            var fragment = document.createDocumentFragment();
+            messages.forEach(function (message) {
+                fragment.appendChild(renderMessage(message));
+            });
+            block.appendChild(fragment);
+            block.style.height = '';
+            block.mounted = true;
+        });
+    }
+
+    function unmount(block) {
+        block.wanted = false;
+        if (block.mounted) {
+            block.style.height = block.offsetHeight + 'px';
+            block.textContent = '';
+            block.mounted = false;
+        }
+        // Chunk data is reloaded from the script cache when needed again
+        delete loaded['chunk-' + block.index];
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        load('meta', function (data) {
+            meta = data;
+            formatter = new Intl.DateTimeFormat('en-US', {
+                timeZone: meta.timezone || undefined,
+                month: 'short', day: '2-digit', year: 'numeric',
+                hour: 'numeric', minute: '2-digit', hour12: true
+            });
+
+            var messages = document.getElementById('messages');
+            var observer = new IntersectionObserver(function (entries) {
+                entries.forEach(function (entry) {
+                    if (entry.isIntersecting) {
+                        mount(entry.target);
+                    } else {
+                        unmount(entry.target);
+                    }
+                });
+            }, {rootMargin: '2000px 0px'});
+
+            meta.chunks.forEach(function (numMessages, i) {
+                var block = element('div', 'chunk');
+                block.index = i;
+                block.style.height = numMessages * ESTIMATED_HEIGHT + 'px';
+                messages.appendChild(block);
+                observer.observe(block);
+            });
+        });
+    });
+})();
+"""
+
+
+def data_file(name, data):
+    return 'groupmeViewerLoaded(%s, %s);\n' % (
+        json.dumps(name), json.dumps(data, ensure_ascii=False,
+                                     separators=(',', ':')))
+
+
+def write_data_file(viewer_dir, name, content):
+    path = os.path.join(viewer_dir, '%s.js' % (name))
+    with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+        fp.write(content)
+    os.replace(path + '.tmp', path)
+
+
+class ViewerData(object):
+    # Converts messages to the compact arrays read by VIEWER_JS, giving
+    # every person an index into a shared people list
+    def __init__(self, people, media, system_name):
+        self.people = people
+        self.media = media
+        self.system_name = system_name
+        self.person_ids = {}
+        self.person_list = []
+
+    def person(self, user_id):
+        if user_id not in self.person_ids:
+            self.person_ids[user_id] = len(self.person_list)
+            if user_id in self.people:
+                person = self.people[user_id]
+                avatar_path = self.media['avatars'].get(user_id) \
+                    if person['avatar_url'] else None
+                self.person_list.append([person['name'], avatar_path,
+                                         person['name'] == self.system_name])
+            else:
+                self.person_list.append(['Unknown', None, False])
+        return self.person_ids[user_id]
+
+    def message(self, message, new_day):
+        mentions = []
+        media = []
+        text = message.text
+        for att in message.attachments:
+            if att['type'] == 'mentions':
+                mentions += att['loci']
+            if att['type'] not in ('image', 'linked_image', 'video'):
+                continue
+            key = media_manifest.attachment_key(att['url'])
+            att_path = self.media['attachments'].get(key)
+            if att_path is None:
+                continue
+            if att['type'] == 'video':
+                media.append(['v', att_path, self.media['posters'].get(key)])
+            else:
+                media.append(['i', att_path,
+                              self.media['thumbnails'].get(key)])
+
+        # Video urls are left out of the text, as on the static pages
+        if text:
+            for att in message.attachments:
+                if att['type'] == 'video':
+                    start_idx = text.find(att['url'])
+                    end_idx = start_idx + len(att['url'])
+                    text = text[:start_idx] + text[end_idx:]
+
+        compact = [self.person(message.author), message.created_at,
+                   text, [self.person(k) for k in message.favorited_by],
+                   media, mentions, 1 if new_day else 0]
+        while not compact[-1]:
+            compact.pop()
+        return compact
+
+
+def chunk_messages(messages, timezone=None):
+    # Yields chunks of (message, new day) that end on a change of day, or
+    # partway through a day with more messages than a chunk can hold. Each
+    # message keeps its own new day flag, so a split day still shows one
+    # divider.
+    chunk = []
+    prev_day = None
+    for message in messages:
+        day = datetime.fromtimestamp(message.created_at, timezone).date()
+        if len(chunk) >= VIEWER_CHUNK_SIZE and day != prev_day or \
+           len(chunk) >= VIEWER_MAX_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+        chunk.append((message, day != prev_day))
+        prev_day = day
+
+    if chunk:
+        yield chunk
+
+
+def write_viewer(input_dir, people, media, messages, system_name,
+                 timezone_name=None, timezone=None, previous=None):
+    # Returns the digest of every chunk file, and only writes the chunks
+    # that differ from the previous render
+    viewer_dir = os.path.join(input_dir, VIEWER_DIR)
+    os.makedirs(viewer_dir, exist_ok=True)
+    previous_pages = (previous or {}).get('pages', {})
+    data = ViewerData(people, media, system_name)
+    digests = {}
+    chunk_sizes = []
+
+    for i, chunk in enumerate(chunk_messages(messages, timezone)):
+        name = 'chunk-%d' % (i)
+        file_name = '%s/%s.js' % (VIEWER_DIR, name)
+        content = data_file(name, [data.message(m, new_day)
+                                   for m, new_day in chunk])
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        digests[file_name] = digest
+        chunk_sizes.append(len(chunk))
+        if previous_pages.get(file_name) != digest or \
+           not os.path.exists(os.path.join(input_dir, file_name)):
+            write_data_file(viewer_dir, name, content)
+
+    write_data_file(viewer_dir, 'meta', data_file('meta', {
+        'timezone': timezone_name,
+        'chunks': chunk_sizes,
+        'people': data.person_list
+    }))
+    with open(os.path.join(viewer_dir, 'viewer.js'), 'w') as fp:
+        fp.write(VIEWER_JS)
+
+    return digests
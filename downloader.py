@@ -0,0 +1,160 @@
+import contextvars
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+import run_metrics
+from http_retry import RETRY_STATUSES, RetryPolicy
+
+CHUNK_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 60
+
+
+def make_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def part_path_for(path):
+    # Hidden so that interrupted downloads never look complete
+    return os.path.join(os.path.dirname(path),
+                        '.%s.part' % (os.path.basename(path)))
+
+
+def link_cached(cached_path, base_path):
+    # Reuses a file downloaded earlier for the same url
+    path = '%s.%s' % (base_path, cached_path.rsplit('.', 1)[1])
+    if os.path.abspath(path) != os.path.abspath(cached_path):
+        part_path = part_path_for(path)
+        link_or_copy(cached_path, part_path)
+        os.replace(part_path, path)
+    return path
+
+
+class MediaDownloader(object):
+    def __init__(self, num_workers=8, host_limit=4, session=None,
+                 retry_policy=None, media_store=None):
+        self.media_store = media_store
+        self.num_workers = num_workers
+        self.host_limit = host_limit
+        self.session = session or make_session(num_workers)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+        self.lock = threading.Lock()
+        self.host_semaphores = {}
+        self.bytes_downloaded = 0
+
+        # Files already fetched by this downloader, so that media shared
+        # between several archived chats is only downloaded once
+        self.downloaded_urls = {}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = \
+                    threading.BoundedSemaphore(self.host_limit)
+            return self.host_semaphores[host]
+
+    def fetch(self, url, base_path):
+        with self.lock:
+            cached_path = self.downloaded_urls.get(url)
+        if cached_path is None and self.media_store is not None:
+            cached_path = self.media_store.lookup(url)
+        if cached_path is not None and os.path.exists(cached_path):
+            run_metrics.metrics.count('cached_files')
+            return link_cached(cached_path, base_path), 0
+
+        result = {}
+
+        def attempt():
+            # The file extension is only known once the response headers
+            # arrive, so the body is streamed to a temporary file first.
+            # Streaming is part of the attempt so that dropped connections
+            # are retried as well.
+            with self.host_semaphore(url):
+                r = self.session.get(url, stream=True,
+                                     timeout=REQUEST_TIMEOUT)
+                if r.status_code in RETRY_STATUSES:
+                    return r
+                with r:
+                    r.raise_for_status()
+                    img_type = r.headers['content-type'].split('/')[1]
+                    result['path'] = '%s.%s' % (base_path, img_type)
+                    part_path = part_path_for(result['path'])
+                    result['size'] = 0
+                    with open(part_path, 'wb') as fp:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            fp.write(chunk)
+                            result['size'] += len(chunk)
+                    os.replace(part_path, result['path'])
+                return r
+
+        self.retry_policy.call(attempt).raise_for_status()
+        path = result['path']
+        size = result['size']
+        self.retry_policy.stats.record_bytes(size)
+
+        with self.lock:
+            self.bytes_downloaded += size
+            self.downloaded_urls[url] = path
+        if self.media_store is not None:
+            self.media_store.add(url, path)
+        return path, size
+
+    def submit(self, url, base_path):
+        # Starts a download in the background, recorded under the caller's
+        # phase
+        return self.executor.submit(contextvars.copy_context().run,
+                                    self.fetch, url, base_path)
+
+    def wait_all(self, futures, progress=True):
+        # Waits for downloads started with submit(), given as a dict of
+        # future: (url, base path)
+        downloaded = {}
+        failed = []
+        num_bytes = 0
+        start_time = time.time()
+
+        pbar = tqdm(total=len(futures), disable=not progress)
+        for future in as_completed(futures):
+            url, base_path = futures[future]
+            try:
+                downloaded[base_path], size = future.result()
+                num_bytes += size
+            except (requests.RequestException, OSError, KeyError) as e:
+                failed.append(url)
+                tqdm.write("Failed to fetch %s: %s" % (url, e))
+
+            elapsed = max(time.time() - start_time, 1e-6)
+            pbar.set_postfix_str('%sB/s' % (
+                tqdm.format_sizeof(num_bytes / elapsed)))
+            pbar.update(1)
+        pbar.close()
+
+        return downloaded, failed, num_bytes
+
+    def fetch_all(self, jobs, progress=True):
+        return self.wait_all({self.submit(url, base_path): (url, base_path)
+                              for url, base_path in jobs}, progress)
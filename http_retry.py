@@ -0,0 +1,136 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import run_metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+
+class RequestStats(object):
+    # Totals for the run summary. Every request is also recorded under the
+    # current phase in run_metrics, labelled with the name of the client.
+    def __init__(self, name='http'):
+        self.name = name
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_bytes = 0
+        self.num_retries = 0
+        self.retry_wait = 0.0
+        self.throttle_wait = 0.0
+        self.statuses = {}
+
+    def record_request(self, status, latency=None):
+        with self.lock:
+            self.num_requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        run_metrics.metrics.record_request(self.name, status, latency)
+
+    def record_bytes(self, num_bytes):
+        with self.lock:
+            self.num_bytes += num_bytes
+        run_metrics.metrics.record_bytes(self.name, num_bytes)
+
+    def record_retry(self, delay):
+        with self.lock:
+            self.num_retries += 1
+            self.retry_wait += delay
+        run_metrics.metrics.record_retry(self.name, delay)
+
+    def record_throttle(self, delay):
+        with self.lock:
+            self.throttle_wait += delay
+
+    def summary(self):
+        return "%d requests, %d retries, %.1fs waiting on retries, " \
+               "%.1fs throttled" % (self.num_requests, self.num_retries,
+                                    self.retry_wait, self.throttle_wait)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Returns the time spent waiting for a token
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def parse_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+class RetryPolicy(object):
+    def __init__(self, max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 stats=None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats = stats or RequestStats()
+
+    def backoff(self, num_retry):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** num_retry))
+
+    def call(self, attempt):
+        # attempt() sends one request and returns its response. Throttled
+        # and failed responses are retried, and the last response is
+        # returned once retries run out so the caller can report it.
+        num_retry = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = attempt()
+            except RETRY_EXCEPTIONS:
+                self.stats.record_request('error',
+                                          time.perf_counter() - start)
+                if num_retry >= self.max_retries:
+                    raise
+                delay = self.backoff(num_retry)
+            else:
+                self.stats.record_request(response.status_code,
+                                          time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUSES or \
+                   num_retry >= self.max_retries:
+                    return response
+                delay = parse_retry_after(response)
+                if delay is None:
+                    delay = self.backoff(num_retry)
+                response.close()
+
+            self.stats.record_retry(delay)
+            time.sleep(delay)
+            num_retry += 1
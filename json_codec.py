@@ -0,0 +1,46 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Archive files are written exactly as the stdlib json module always wrote
+# them unless compact output is turned on, in which case they are written
+# without indentation or spaces, with orjson when it is installed
+compact = False
+
+
+def configure(compact_output):
+    global compact
+    compact = compact_output
+
+
+def loads(data):
+    # Takes str or bytes. orjson is stricter than the json module, e.g.
+    # about lone surrogates, so anything it rejects gets a second chance.
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def load(fp):
+    return loads(fp.read())
+
+
+def dumps(obj, indent=None):
+    if not compact:
+        return json.dumps(obj, ensure_ascii=False, indent=indent)
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def dump(obj, fp, indent=None):
+    fp.write(dumps(obj, indent))
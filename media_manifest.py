@@ -0,0 +1,44 @@
+import os
+
+import json_codec
+
+MANIFEST_FILE = "media_manifest.json"
+
+
+def scan_media(archive_dir):
+    # Files are saved as avatars/<user id>.avatar.<ext> and
+    # attachments/<url basename>.<ext>
+    manifest = {'avatars': {}, 'attachments': {}}
+    for kind in manifest:
+        media_dir = os.path.join(archive_dir, kind)
+        if not os.path.isdir(media_dir):
+            continue
+        for entry in os.scandir(media_dir):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            key = entry.name.rsplit('.', 1)[0]
+            if kind == 'avatars':
+                if not key.endswith('.avatar'):
+                    continue
+                key = key[:-len('.avatar')]
+            manifest[kind][key] = '%s/%s' % (kind, entry.name)
+    return manifest
+
+
+def load_manifest(archive_dir):
+    manifest_file = os.path.join(archive_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return scan_media(archive_dir)
+    with open(manifest_file, encoding='utf-8') as fp:
+        return json_codec.load(fp)
+
+
+def save_manifest(archive_dir, manifest):
+    manifest_file = os.path.join(archive_dir, MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w', encoding='utf-8') as fp:
+        json_codec.dump(manifest, fp, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def attachment_key(url):
+    return url.split('/')[-1]
@@ -0,0 +1,67 @@
+import hashlib
+import os
+import re
+import threading
+from urllib.parse import urlparse
+
+from downloader import link_or_copy, part_path_for
+
+
+# Hosts whose url basenames are a hash of the content
+CONTENT_HOSTS = ('i.groupme.com',)
+
+
+class MediaStore(object):
+    # A media folder shared by many archives. GroupMe image urls end in a
+    # content hash, so those objects are keyed by the url basename. Other
+    # urls, such as linked images and videos, can share a basename with
+    # unrelated files and are keyed by a hash of the whole url. Objects
+    # are stored as <store>/<shard>/<key>.<ext>, where the shard comes from
+    # a hash of the key. Archives get hardlinks to the objects (or copies
+    # when the store is on another filesystem).
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+        self.shards = {}
+
+    def key(self, url):
+        parsed = urlparse(url)
+        if parsed.hostname not in CONTENT_HOSTS:
+            return 'url-%s' % (hashlib.sha1(url.encode('utf-8')).hexdigest())
+        name = os.path.basename(parsed.path)
+        return re.sub(r'[^A-Za-z0-9._-]', '_', name)
+
+    def shard(self, key):
+        # Each shard is scanned once and then kept up to date in memory
+        shard_name = hashlib.md5(key.encode('utf-8')).hexdigest()[:2]
+        with self.lock:
+            if shard_name not in self.shards:
+                shard = {}
+                shard_dir = os.path.join(self.store_dir, shard_name)
+                if os.path.isdir(shard_dir):
+                    for entry in os.scandir(shard_dir):
+                        if not entry.name.startswith('.'):
+                            shard[entry.name.rsplit('.', 1)[0]] = entry.path
+                self.shards[shard_name] = shard
+            return shard_name, self.shards[shard_name]
+
+    def lookup(self, url):
+        _, shard = self.shard(self.key(url))
+        with self.lock:
+            return shard.get(self.key(url))
+
+    def add(self, url, path):
+        key = self.key(url)
+        shard_name, shard = self.shard(key)
+        shard_dir = os.path.join(self.store_dir, shard_name)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        object_path = os.path.join(shard_dir, '%s.%s' % (
+            key, path.rsplit('.', 1)[1]))
+        part_path = part_path_for(object_path)
+        link_or_copy(path, part_path)
+        os.replace(part_path, object_path)
+
+        with self.lock:
+            shard[key] = object_path
+        return object_path
@@ -0,0 +1,184 @@
+import argparse
+import os
+import sys
+
+import json_codec
+
+MESSAGES_FILE = "messages.jsonl"
+LEGACY_MESSAGES_FILE = "messages.json"
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Shared by every message without likes or attachments
+NO_ITEMS = ()
+
+
+class Message(object):
+    # In-memory form of an archived message. Slots instead of a dict,
+    # interned user ids and a shared empty tuple for the many messages
+    # without likes or attachments keep millions of them small.
+    __slots__ = ('id', 'author', 'created_at', 'text', 'favorited_by',
+                 'attachments')
+
+    def __init__(self, message_id, author, created_at, text,
+                 favorited_by=NO_ITEMS, attachments=NO_ITEMS):
+        self.id = message_id
+        self.author = sys.intern(author)
+        self.created_at = created_at
+        self.text = text
+        self.favorited_by = tuple(map(sys.intern, favorited_by)) \
+            if favorited_by else NO_ITEMS
+        self.attachments = tuple(attachments) if attachments else NO_ITEMS
+
+    def to_dict(self):
+        # The stored form, which render digests are also taken of. Messages
+        # converted from archives made before ids were saved have none.
+        message = {} if self.id is None else {'id': self.id}
+        message['author'] = self.author
+        message['created_at'] = self.created_at
+        message['text'] = self.text
+        message['favorited_by'] = list(self.favorited_by)
+        message['attachments'] = list(self.attachments)
+        return message
+
+
+def to_message(message):
+    return Message(message.get('id'), message['author'],
+                   message['created_at'], message['text'],
+                   message['favorited_by'], message['attachments'])
+
+
+def write_message(fp, message):
+    fp.write(json_codec.dumps(message.to_dict()))
+    fp.write('\n')
+
+
+def parse_line(line):
+    # A run that was killed mid-write can leave a truncated last line
+    try:
+        return to_message(json_codec.loads(line))
+    except ValueError:
+        return None
+
+
+def iter_messages_file(path):
+    # Lines are parsed straight from bytes, which saves decoding them
+    with open(path, 'rb') as fp:
+        for line in fp:
+            message = parse_line(line)
+            if message is not None:
+                yield message
+
+
+def iter_lines_file(path):
+    # For readers that parse the lines elsewhere, with parse_line()
+    with open(path, 'rb') as fp:
+        yield from fp
+
+
+def iter_lines_reversed(path):
+    with open(path, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        position = fp.tell()
+        remainder = b''
+        while position > 0:
+            read_size = min(READ_BLOCK_SIZE, position)
+            position -= read_size
+            fp.seek(position)
+            lines = (fp.read(read_size) + remainder).split(b'\n')
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                if line:
+                    yield line.decode('utf-8')
+        if remainder:
+            yield remainder.decode('utf-8')
+
+
+def iter_messages_reversed(path):
+    for line in iter_lines_reversed(path):
+        message = parse_line(line)
+        if message is not None:
+            yield message
+
+
+def read_last_message(path):
+    if not os.path.exists(path):
+        return None
+    return next(iter_messages_reversed(path), None)
+
+
+def truncate_partial_line(path):
+    # Drop a trailing half-written line so that appends start cleanly
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        position = size
+        while position > 0:
+            read_size = min(READ_BLOCK_SIZE, position)
+            fp.seek(position - read_size)
+            block = fp.read(read_size)
+            newline_idx = block.rfind(b'\n')
+            if newline_idx != -1:
+                position = position - read_size + newline_idx + 1
+                break
+            position -= read_size
+        if position != size:
+            fp.truncate(position)
+
+
+def has_messages(archive_dir):
+    return os.path.exists(os.path.join(archive_dir, MESSAGES_FILE)) or \
+        os.path.exists(os.path.join(archive_dir, LEGACY_MESSAGES_FILE))
+
+
+def iter_messages(archive_dir):
+    messages_file = os.path.join(archive_dir, MESSAGES_FILE)
+    if os.path.exists(messages_file):
+        yield from iter_messages_file(messages_file)
+        return
+
+    legacy_messages_file = os.path.join(archive_dir, LEGACY_MESSAGES_FILE)
+    with open(legacy_messages_file, encoding='utf-8') as fp:
+        messages = json_codec.load(fp)
+    for i, message in enumerate(messages):
+        yield to_message(message)
+        # Drop each message once it is converted
+        messages[i] = None
+
+
+def convert_archive(archive_dir):
+    legacy_messages_file = os.path.join(archive_dir, LEGACY_MESSAGES_FILE)
+    messages_file = os.path.join(archive_dir, MESSAGES_FILE)
+
+    with open(legacy_messages_file, encoding='utf-8') as fp:
+        messages = json_codec.load(fp)
+
+    with open(messages_file + '.tmp', 'w', encoding='utf-8') as fp:
+        for message in messages:
+            write_message(fp, to_message(message))
+    os.replace(messages_file + '.tmp', messages_file)
+
+    return len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Convert an archive's
+        messages.json into the newline-delimited messages.jsonl store.
+        """)
+    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.input_dir,
+                                       LEGACY_MESSAGES_FILE)):
+        print("Missing files!")
+        sys.exit(1)
+
+    num_messages = convert_archive(args.input_dir)
+    print("Converted %d messages" % (num_messages))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,35 @@
 import argparse
+import calendar
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import glob
 import html
-import json
+from itertools import islice
 import os
 import pytz
 import shutil
 import sys
+import threading
 import time
 
 from yattag import Doc
 
+import archive_server
+import archive_sqlite
+import chat_viewer
+import json_codec
+import media_manifest
+import message_store
+import render_manifest
+import run_metrics
+import search_index
+import segment_store
+import thumbnails
+
 # Constants
 __SYSTEM__ = "GroupMe"
 FONT_URL = "https://fonts.googleapis.com/css?family=Open+Sans"
+CHUNK_SIZE = 2000
 
 
 def css_file():
@@ -89,11 +105,54 @@ def css_file():
         max-height: 400px;
     }
 
+    .message > a > img {
+        max-width: 400px;
+        max-height: 400px;
+    }
+
     .message > video {
         max-width: 400px;
         max-height: 400px;
     }
 
+    .page_nav {
+        display: flex;
+        flex-direction: row;
+        justify-content: space-between;
+        padding-top: 10px;
+        padding-bottom: 10px;
+        color: #bbbbbb;
+    }
+
+    .page_nav > a {
+        color: #3A61BF;
+    }
+
+    .page_summary {
+        color: #666666;
+    }
+
+    .search > input {
+        width: 100%;
+        box-sizing: border-box;
+        padding: 5px;
+        font-size: 14px;
+    }
+
+    .search_summary {
+        padding-top: 5px;
+        color: #666666;
+    }
+
+    .search_result {
+        display: flex;
+        flex-direction: column;
+        padding-top: 5px;
+        padding-bottom: 5px;
+        color: inherit;
+        text-decoration: none;
+    }
+
     .system_message {
         width: 80%;
 
@@ -164,207 +223,906 @@ def css_file():
     """
 
 
-def render_time_message(page_elements, message, prev_time, timezone=None):
+# Message times are shown as DATE_FORMAT at TIME_FORMAT
+DATE_FORMAT = '%b %d, %Y'
+TIME_FORMAT = '%-I:%M %p'
+
+# HTML fragments that messages are rendered from, as yattag used to write
+# them out. Attribute values and text are escaped the same way.
+TIME_DIVIDER = ('<div class="message_container" style="background-color: '
+                '#e4e4e4"><span class="system_message">%s</span></div>')
+SYSTEM_MESSAGE = ('<div class="message_container" title="%s"%s '
+                  'style="background-color: #e4e4e4"><span '
+                  'class="system_message">%s</span></div>')
+MESSAGE_START = '<div class="message_container" title="%s"%s>'
+ANCHOR = ' id="%s"'
+AVATAR = '<div class="avatar">%s</div>'
+AVATAR_IMAGE = '<img src="%s"></img>'
+MESSAGE_BOX = '<div class="message_box"><span class="user">%s</span>'
+IMAGE = '<span class="message"><img src="%s"></img></span>'
+THUMBNAIL = ('<span class="message"><a href="%s"><img src="%s" '
+             'loading="lazy"></img></a></span>')
+VIDEO = '<span class="message"><video src="%s" controls></video></span>'
+VIDEO_POSTER = ('<span class="message"><video src="%s" poster="%s" '
+                'preload="none" controls></video></span>')
+TEXT_START = '<span class="message">'
+TEXT_PART = '<span style="font-weight: %s;">%s</span>'
+TEXT_END = '</span>'
+LIKES = ('</div><span class="likes tooltip">'
+         "<img src='assets/heart-full.png'></img>%d"
+         '<div class="tooltiptext">%s</div></span></div>')
+NO_LIKES = ('</div><span class="likes"><img src=\'assets/heart.png\'></img>'
+            '<div class="tooltiptext"></div></span></div>')
+LIKED_BY = '<div>%s</div>'
+
+
+def escape_text(value):
+    return html.escape(value, quote=False)
+
+
+def escape_attr(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('"', '&quot;')
+
+
+class MessageTimes(object):
+    # Formats message times once per minute. Timezone offsets are whole
+    # minutes, so every message in a minute shows the same time. As chats
+    # are sorted, the last minute seen is kept, and since a minute is
+    # often the first one seen that day or time of day, dates are also
+    # formatted once per day and times of day once each.
+    def __init__(self, timezone=None):
+        self.timezone = timezone
+        self.minute = None
+        self.times = None
+        self.dates = {}
+        self.clock_times = {}
+
+    def lookup(self, created_at):
+        # Returns (day of the month, time as text, time as attribute)
+        minute = created_at // 60
+        if minute != self.minute:
+            message_time = datetime.fromtimestamp(created_at, self.timezone)
+            date_key = (message_time.year, message_time.month,
+                        message_time.day)
+            date = self.dates.get(date_key)
+            if date is None:
+                label = message_time.strftime(DATE_FORMAT)
+                date = self.dates[date_key] = (escape_text(label),
+                                               escape_attr(label))
+            time_key = (message_time.hour, message_time.minute)
+            clock_time = self.clock_times.get(time_key)
+            if clock_time is None:
+                label = message_time.strftime(TIME_FORMAT)
+                clock_time = self.clock_times[time_key] = (
+                    escape_text(label), escape_attr(label))
+            self.minute = minute
+            self.times = (message_time.day,
+                          '%s at %s' % (date[0], clock_time[0]),
+                          '%s at %s' % (date[1], clock_time[1]))
+        return self.times
+
+
+class MessageRenderer(object):
+    # Writes messages out as HTML fragments filled in with their fields.
+    # Names, avatars and liked-by entries are escaped once per person, and
+    # times formatted once per minute.
+    def __init__(self, media, people, timezone=None, search=False):
+        self.media = media
+        self.people = people
+        self.search = search
+        self.times = MessageTimes(timezone)
+        self.avatars = {}
+        self.names = {}
+        self.liked_by = {}
+
+    def avatar(self, user_id):
+        if user_id not in self.avatars:
+            avatar_path = self.media['avatars'].get(user_id)
+            if self.people[user_id]['avatar_url'] and avatar_path:
+                inner = AVATAR_IMAGE % (avatar_path)
+            else:
+                names = self.people[user_id]['name'].split()
+                shorthand = names[0][0].upper()
+                if len(names) > 1:
+                    shorthand += names[-1][0].upper()
+                inner = escape_text(shorthand)
+            self.avatars[user_id] = AVATAR % (inner)
+        return self.avatars[user_id]
+
+    def name(self, user_id):
+        if user_id not in self.names:
+            self.names[user_id] = escape_text(self.people[user_id]['name'])
+        return self.names[user_id]
+
+    def liker(self, user_id):
+        if user_id not in self.liked_by:
+            name = "Unknown"
+            if user_id in self.people:
+                name = self.people[user_id]['name']
+            self.liked_by[user_id] = LIKED_BY % (escape_text(name))
+        return self.liked_by[user_id]
+
+    def render(self, messages, write, prev_time=None):
+        # prev_time is the time of the message before these, for chunks
+        # rendered apart from the rest of the chat
+        prev_day = None
+        if prev_time is not None:
+            prev_day = self.times.lookup(prev_time)[0]
+        for message in messages:
+            day, time_text, time_attr = self.times.lookup(message.created_at)
+
+            # Handle change in day
+            if prev_day is None or prev_day != day:
+                write(TIME_DIVIDER % (time_text))
+            prev_day = day
+
+            # Messages get anchors for search results to link to
+            anchor = ''
+            if self.search:
+                message_anchor = search_index.message_anchor(message)
+                if message_anchor:
+                    anchor = ANCHOR % (escape_attr(message_anchor))
+
+            if self.people[message.author]['name'] == __SYSTEM__:
+                write(SYSTEM_MESSAGE % (
+                    time_attr, anchor,
+                    escape_text(message.text or '<ATTACHMENT>')))
+            else:
+                self.render_message(message, time_attr, anchor, write)
+
+    def render_message(self, message, time_attr, anchor, write):
+        media = self.media
+        write(MESSAGE_START % (time_attr, anchor))
+        write(self.avatar(message.author))
+        write(MESSAGE_BOX % (self.name(message.author)))
+
+        mentions = []
+        for att in message.attachments:
+            if att['type'] == "mentions":
+                mentions += att['loci']
+            if att['type'] not in ('image', 'linked_image', 'video'):
+                continue
+            att_key = media_manifest.attachment_key(att['url'])
+            att_path = media['attachments'].get(att_key)
+            if att_path is None:
+                continue
+            # Thumbnails and poster frames are used when they have been
+            # made (see thumbnails.py)
+            if att['type'] == 'video':
+                poster_path = media['posters'].get(att_key)
+                if poster_path:
+                    write(VIDEO_POSTER % (att_path, poster_path))
+                else:
+                    write(VIDEO % (att_path))
+            else:
+                thumbnail_path = media['thumbnails'].get(att_key)
+                if thumbnail_path:
+                    write(THUMBNAIL % (att_path, thumbnail_path))
+                else:
+                    write(IMAGE % (att_path))
+
+        if message.text:
+            _text = message.text
+
+            # Remove video urls
+            for att in message.attachments:
+                if att['type'] == 'video':
+                    start_idx = _text.find(att['url'])
+                    end_idx = start_idx + len(att['url'])
+                    _text = _text[:start_idx] + _text[end_idx:]
+
+            # Split text into mentions and normal text
+            write(TEXT_START)
+            prev_end = 0
+            for m in mentions:
+                start = m[0]
+                end = start + m[1]
+                write(TEXT_PART % ('normal',
+                                   escape_text(_text[prev_end:start])))
+                write(TEXT_PART % ('bold', escape_text(_text[start:end])))
+                prev_end = end
+            write(TEXT_PART % ('normal', escape_text(_text[prev_end:])))
+            write(TEXT_END)
+
+        if len(message.favorited_by) > 0:
+            write(LIKES % (len(message.favorited_by),
+                           ''.join(self.liker(user_id)
+                                   for user_id in message.favorited_by)))
+        else:
+            write(NO_LIKES)
+
+
+def render_page_head(page_elements, title, search=False):
     doc, tag, text = page_elements
 
-    # Handle change in day
-    message_time = datetime.fromtimestamp(message['created_at'], timezone)
+    with tag('head'):
+        doc.asis('<meta charset="utf-8">')
+        doc.asis('<link href="%s" rel="stylesheet">' % (FONT_URL))
+        doc.asis('<link rel="stylesheet" href="main.css">')
+        if search:
+            doc.asis('<script src="%s/search.js"></script>' % (
+                search_index.SEARCH_DIR))
 
-    if prev_time is None or prev_time.day != message_time.day:
-        with tag('div', klass='message_container'):
-            doc.attr(style="background-color: #e4e4e4")
-            with tag('span', klass='system_message'):
-                text(message_time.strftime('%b %d, %Y at %-I:%M %p'))
+        with tag('title'):
+            text(title)
 
-    return message_time
 
-
-def render_system_message(page_elements, message, timezone=None):
+def render_page_nav(page_elements, nav):
     doc, tag, text = page_elements
 
-    message_time = datetime.fromtimestamp(message['created_at'], timezone)
-    with tag('div', klass='message_container'):
-        doc.attr(title=message_time.strftime('%b %d, %Y at %-I:%M %p'))
-        doc.attr(style="background-color: #e4e4e4")
-        with tag('span', klass='system_message'):
-            text(message['text'] or '<ATTACHMENT>')
+    with tag('div', klass='page_nav'):
+        for key, label in (('prev', '« Previous'), ('index', 'Index'),
+                           ('next', 'Next »')):
+            if nav.get(key):
+                with tag('a', href=nav[key]):
+                    text(label)
+            else:
+                with tag('span'):
+                    text(label)
 
 
-def render_avatar(input_dir, page_elements, people, message):
+def render_search_box(page_elements):
     doc, tag, text = page_elements
 
-    avatar_url = people[message['author']]['avatar_url']
-    if avatar_url:
-        avatar_path = "%s.avatar" % (message['author'])
-        avatar_path = os.path.join('avatars', avatar_path)
-        avatar_path = glob.glob("%s/%s*" % (input_dir, avatar_path))[0]
-        avatar_path = "/".join(avatar_path.split('/')[-2:])
-        doc.asis('<img src="%s"></img>' % (avatar_path))
-    else:
-        names = people[message['author']]['name'].split()
-        shorthand = names[0][0].upper()
-        if len(names) > 1:
-            shorthand += names[-1][0].upper()
-        text(shorthand)
+    with tag('div', klass='search'):
+        doc.stag('input', type='search', id='search_input',
+                 placeholder='Search messages')
+        with tag('div', id='search_results'):
+            pass
 
 
-def render_message(input_dir, page_elements, people, message, timezone=None):
+def render_messages(media, people, messages, timezone=None, search=False):
+    parts = []
+    MessageRenderer(media, people, timezone, search).render(messages,
+                                                            parts.append)
+    return ''.join(parts)
+
+
+def render_page_start(group_info, nav=None, search=False):
+    page_elements = Doc().tagtext()
     doc, tag, text = page_elements
 
-    # Process mentions
-    mentions = []
-    for a in message['attachments']:
-        if a['type'] == "mentions":
-            mentions += a['loci']
-
-    message_time = datetime.fromtimestamp(message['created_at'], timezone)
-    with tag('div', klass='message_container'):
-        doc.attr(title=message_time.strftime('%b %d, %Y at %-I:%M %p'))
-        with tag('div', klass='avatar'):
-            render_avatar(input_dir, page_elements, people, message)
-        with tag('div', klass='message_box'):
-            with tag('span', klass='user'):
-                text(people[message['author']]['name'])
-            if len(message['attachments']) > 0:
-                for att in message['attachments']:
-                    if att['type'] == 'image' or \
-                       att['type'] == 'linked_image':
-                        image_path = att['url'].split('/')[-1]
-                        image_path = os.path.join('attachments', image_path)
-                        r = glob.glob("%s/%s*" % (input_dir, image_path))
-                        image_path = r[0]
-                        image_path = "/".join(image_path.split('/')[-2:])
-                        with tag('span', klass='message'):
-                            doc.asis('<img src="%s"></img>' % (
-                                image_path))
-                    elif att['type'] == 'video':
-                        video_path = att['url'].split('/')[-1]
-                        video_path = os.path.join('attachments', video_path)
-                        r = glob.glob("%s/%s*" % (input_dir, video_path))[0]
-                        video_path = r
-                        video_path = "/".join(video_path.split('/')[-2:])
-                        with tag('span', klass='message'):
-                            doc.asis('<video src="%s" controls></video>' % (
-                                video_path))
-            if message['text']:
-                with tag('span', klass='message'):
-                    _text = message['text']
-
-                    # Remove video urls
-                    for att in message['attachments']:
-                        if att['type'] == 'video':
-                            start_idx = _text.find(att['url'])
-                            end_idx = start_idx + len(att['url'])
-                            _text = _text[:start_idx] + _text[end_idx:]
-
-                    # Split text into mentions and normal text
-                    text_parts = []
-                    prev_end = 0
-
-                    for m in mentions:
-                        start = m[0]
-                        end = start + m[1]
-
-                        text_parts.append((_text[prev_end:start], 'normal'))
-                        text_parts.append((_text[start:end], 'bold'))
-                        prev_end = end
-
-                    text_parts.append((_text[prev_end:], 'normal'))
-
-                    for t, style in text_parts:
-                        with tag('span'):
-                            doc.attr('style="font-weight: %s;"' % (style))
-                            text(t)
-        with tag('span', klass='likes'):
-            if len(message['favorited_by']) > 0:
-                doc.attr(klass='likes tooltip')
-                doc.asis("<img src='assets/heart-full.png'></img>")
-                doc.text(len(message['favorited_by']))
-            else:
-                doc.asis("<img src='assets/heart.png'></img>")
-            with tag('div', klass='tooltiptext'):
-                for id in message['favorited_by']:
-                    name = "Unknown"
-                    if id in people:
-                        name = people[id]['name']
-                    with tag('div'):
-                        text(name)
+    title = 'GroupMe archive - %s' % (group_info['name'])
+    if nav:
+        title += ' - %s' % (nav['label'])
 
+    # The page is left open so that message fragments can be streamed in
+    # before render_page_end closes it
+    doc.asis('<html>')
+    render_page_head(page_elements, title, search)
+    doc.asis('<body><div id="container">')
+    with tag('h1'):
+        text(group_info['name'])
+    if search:
+        render_search_box(page_elements)
+    if nav:
+        render_page_nav(page_elements, nav)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
-    parser.add_argument('--timezone', type=str,
-                        help="Timezone to render message times in.")
+    return doc.getvalue()
 
-    args = parser.parse_args()
 
-    if not os.path.exists(os.path.join(args.input_dir, 'people.json')) or \
-       not os.path.exists(os.path.join(args.input_dir, 'messages.json')) or \
-       not os.path.exists(os.path.join(args.input_dir, 'group_info.json')):
-        print("Missing files!")
-        sys.exit(1)
+def render_page_end(nav=None):
+    page_elements = Doc().tagtext()
+    doc, tag, text = page_elements
 
-    with open(os.path.join(args.input_dir, 'people.json')) as fp:
-        people = json.load(fp)
+    if nav:
+        render_page_nav(page_elements, nav)
+    doc.asis('</div></body></html>')
 
-    with open(os.path.join(args.input_dir, 'messages.json')) as fp:
-        messages = json.load(fp)
+    return doc.getvalue()
 
-    with open(os.path.join(args.input_dir, 'group_info.json')) as fp:
-        group_info = json.load(fp)
 
+def render_index(group_info, pages, timezone=None, search=False):
     page_elements = Doc().tagtext()
     doc, tag, text = page_elements
 
-    tz = None
-    if args.timezone:
-        tz = pytz.timezone(args.timezone)
-
-    prev_time = None
     with tag('html'):
-        with tag('head'):
-            doc.asis('<meta charset="utf-8">')
-            doc.asis('<link href="%s" rel="stylesheet">' % (FONT_URL))
-            doc.asis('<link rel="stylesheet" href="main.css">')
+        render_page_head(page_elements,
+                         'GroupMe archive - %s' % (group_info['name']),
+                         search)
+        with tag('body'):
+            with tag('div', id='container'):
+                with tag('h1'):
+                    text(group_info['name'])
+                if search:
+                    render_search_box(page_elements)
+                with tag('ul', klass='page_index'):
+                    for file_name, label, num_messages, start, end in pages:
+                        start = datetime.fromtimestamp(start, timezone)
+                        end = datetime.fromtimestamp(end, timezone)
+                        with tag('li'):
+                            with tag('a', href=file_name):
+                                text(label)
+                            with tag('span', klass='page_summary'):
+                                text(' %d messages, %s - %s' % (
+                                    num_messages,
+                                    start.strftime('%b %d, %Y'),
+                                    end.strftime('%b %d, %Y')))
+
+    return doc.getvalue()
+
+
+def render_month_index(group_info, months):
+    # Index of the pages --serve renders on request
+    page_elements = Doc().tagtext()
+    doc, tag, text = page_elements
 
-            with tag('title'):
-                text('GroupMe archive - %s' % (group_info['name']))
+    with tag('html'):
+        render_page_head(page_elements,
+                         'GroupMe archive - %s' % (group_info['name']))
         with tag('body'):
             with tag('div', id='container'):
                 with tag('h1'):
                     text(group_info['name'])
+                with tag('ul', klass='page_index'):
+                    with tag('li'):
+                        with tag('a', href='messages.html'):
+                            text('All messages')
+                    for year, month in months:
+                        with tag('li'):
+                            with tag('a', href='rendered-%04d-%02d.html' % (
+                                    year, month)):
+                                text(datetime(year, month, 1).strftime(
+                                    '%B %Y'))
 
-                # Render messages
-                for message in messages:
-                    # Check and render time divider
-                    prev_time = render_time_message(page_elements, message,
-                                                    prev_time, tz)
-
-                    # Check message type
-                    if people[message['author']]['name'] == __SYSTEM__:
-                        # Render system message
-                        render_system_message(page_elements, message,
-                                              tz)
-                    else:
-                        # Render normal message
-                        render_message(args.input_dir, page_elements, people,
-                                       message, tz)
+    return doc.getvalue()
 
-    # Save rendered files
-    with open(os.path.join(args.input_dir, 'rendered.html'), 'w') as fp:
-        fp.write(doc.getvalue())
 
-    with open(os.path.join(args.input_dir, 'main.css'), 'w') as fp:
+def render_viewer_page(group_info):
+    page_elements = Doc().tagtext()
+    doc, tag, text = page_elements
+
+    with tag('html'):
+        render_page_head(page_elements,
+                         'GroupMe archive - %s' % (group_info['name']))
+        with tag('body'):
+            with tag('div', id='container'):
+                with tag('h1'):
+                    text(group_info['name'])
+                with tag('div', id='messages'):
+                    pass
+            doc.asis('<script src="%s/viewer.js"></script>' % (
+                chat_viewer.VIEWER_DIR))
+
+    return doc.getvalue()
+
+
+def month_span(created_at, timezone=None):
+    # Returns the month a message is in and a range of times that are sure
+    # to be in the same month, leaving out a day at either end for changes
+    # in the UTC offset
+    month_time = datetime.fromtimestamp(created_at, timezone)
+    start = created_at - ((month_time.day - 1) * 86400 +
+                          month_time.hour * 3600 + month_time.minute * 60 +
+                          month_time.second)
+    days = calendar.monthrange(month_time.year, month_time.month)[1]
+    return month_time.strftime('%Y-%m'), start + 86400, \
+        start + (days - 1) * 86400
+
+
+def paginate(messages, messages_per_page=None, by_month=False,
+             timezone=None):
+    # Yields (file name, label, messages) for each page
+    page = []
+    page_month = None
+    # Times are only converted to months near the ends of a month
+    month_from = month_until = 0
+    page_part = 1
+    page_num = 1
+
+    def finish_page():
+        if by_month:
+            file_name = 'rendered-%s' % (page_month)
+            label = datetime.strptime(page_month, '%Y-%m').strftime('%B %Y')
+            if page_part > 1:
+                file_name += '-%d' % (page_part)
+                label += ' (part %d)' % (page_part)
+        else:
+            file_name = 'rendered-%04d' % (page_num)
+            label = 'Page %d' % (page_num)
+        return '%s.html' % (file_name), label, page
+
+    for message in messages:
+        if by_month and not \
+           month_from <= message.created_at < month_until:
+            month, month_from, month_until = month_span(message.created_at,
+                                                        timezone)
+            if month != page_month:
+                if page:
+                    yield finish_page()
+                    page = []
+                page_month = month
+                page_part = 1
+
+        page.append(message)
+
+        if messages_per_page and len(page) >= messages_per_page:
+            yield finish_page()
+            page = []
+            page_part += 1
+            page_num += 1
+
+    if page:
+        yield finish_page()
+
+
+def chunk_tasks(messages, chunk_size, parse=False):
+    # Chunks are cut by count so that nothing is done per message here.
+    # Each is sent with the time of the message before it, which the worker
+    # needs to tell whether the chunk starts on a new day. With parse, the
+    # chunks are lines of messages.jsonl for the workers to parse.
+    messages = iter(messages)
+    prev_time = None
+    while True:
+        chunk = list(islice(messages, chunk_size))
+        if not chunk:
+            return
+        yield chunk, prev_time, parse
+        for item in reversed(chunk):
+            message = message_store.parse_line(item) if parse else item
+            if message is not None:
+                prev_time = message.created_at
+                break
+
+
+# Shared by the render workers so that people, media, group information
+# and the previous render are only sent to each process once
+render_context = {}
+
+
+def init_render_context(input_dir, group_info, people, media, timezone,
+                        search=False, settings=None, previous=None):
+    # Without settings, as with --full-render, nothing is digested and
+    # every page is rendered
+    previous = previous or {}
+    previous_chunks = {}
+    if os.path.exists(os.path.join(input_dir, 'rendered.html')):
+        previous_chunks = {digest: (offset, length) for digest, offset, length
+                           in previous.get('chunks', []) if digest}
+    render_context.update({
+        'input_dir': input_dir,
+        'group_info': group_info,
+        'people': people,
+        'media': media,
+        'timezone': timezone,
+        'search': search,
+        'settings': settings,
+        'previous_pages': previous.get('pages', {}),
+        'previous_chunks': previous_chunks,
+        'renderer': MessageRenderer(media, people, timezone, search)
+    })
+
+
+def content_digest(messages, extra=None):
+    # Taken in the workers, as it is about as much work as rendering
+    if render_context['settings'] is None:
+        return None
+    return render_manifest.content_digest(
+        render_context['settings'], render_context['people'],
+        render_context['media'], messages, extra)
+
+
+def render_chunk(messages, prev_time, parse=False):
+    # Returns the chunk's digest and HTML. Unchanged chunks are copied from
+    # the previous render of the page.
+    if parse:
+        messages = [message for message in
+                    map(message_store.parse_line, messages)
+                    if message is not None]
+    renderer = render_context['renderer']
+    prev_day = None
+    if prev_time is not None:
+        prev_day = renderer.times.lookup(prev_time)[0]
+    digest = content_digest(messages, prev_day)
+    cached = render_context['previous_chunks'].get(digest)
+    if cached is not None:
+        offset, length = cached
+        with open(os.path.join(render_context['input_dir'], 'rendered.html'),
+                  'rb') as fp:
+            fp.seek(offset)
+            return digest, fp.read(length)
+
+    parts = []
+    renderer.render(messages, parts.append, prev_time)
+    return digest, ''.join(parts).encode('utf-8')
+
+
+def write_page(file_name, messages, nav):
+    # Returns the page's digest, and only renders the page when it differs
+    # from the previous render. Messages are written out as they are
+    # rendered.
+    digest = content_digest(messages, nav)
+    page_file = os.path.join(render_context['input_dir'], file_name)
+    if digest is not None and os.path.exists(page_file) and \
+       render_context['previous_pages'].get(file_name) == digest:
+        return file_name, digest
+
+    with open(page_file, 'w') as fp:
+        fp.write(render_page_start(render_context['group_info'], nav,
+                                   render_context['search']))
+        render_context['renderer'].render(messages, fp.write)
+        fp.write(render_page_end(nav))
+    return file_name, digest
+
+
+def page_entry(file_name, messages, nav):
+    return (file_name, nav['label'], len(messages),
+            messages[0].created_at, messages[-1].created_at)
+
+
+def run_tasks(func, tasks, jobs, context):
+    # Yields results in task order, with at most a few tasks per worker in
+    # flight so that memory stays bounded on large chats
+    if jobs <= 1:
+        init_render_context(*context)
+        for task in tasks:
+            yield func(*task)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=init_render_context,
+                             initargs=context) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(func, *task))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def page_tasks(pages):
+    # Pages are queued with a single page of lookahead to fill in the next
+    # link, so memory is bounded by the page size
+    prev_file_name = None
+    pending = next(pages, None)
+    while pending is not None:
+        following = next(pages, None)
+        file_name, label, messages = pending
+
+        nav = {
+            'label': label,
+            'index': 'rendered.html',
+            'prev': prev_file_name,
+            'next': following[0] if following else None
+        }
+        yield file_name, messages, nav
+
+        prev_file_name = file_name
+        pending = following
+
+
+def write_pages(input_dir, group_info, pages, jobs, context, timezone=None,
+                search=False):
+    # Returns the digest of every page
+    page_digests = {}
+    index_entries = []
+
+    def tasks():
+        for file_name, messages, nav in page_tasks(pages):
+            index_entries.append(page_entry(file_name, messages, nav))
+            yield file_name, messages, nav
+
+    for file_name, digest in run_tasks(write_page, tasks(), jobs, context):
+        page_digests[file_name] = digest
+
+    page = render_index(group_info, index_entries, timezone, search)
+    with run_metrics.phase('write'):
+        with open(os.path.join(input_dir, 'rendered.html'), 'w') as fp:
+            fp.write(page)
+
+    return page_digests
+
+
+def write_single_page(input_dir, group_info, messages, jobs, context,
+                      search=False, parse=False):
+    # Returns [digest, offset, length] for every chunk of the page, so that
+    # the next render can copy the chunks that have not changed
+    page_file = os.path.join(input_dir, 'rendered.html')
+    tasks = chunk_tasks(messages, CHUNK_SIZE, parse)
+
+    chunks = []
+    with open(page_file + '.tmp', 'wb') as fp:
+        fp.write(render_page_start(group_info, search=search).encode('utf-8'))
+        for digest, fragment in run_tasks(render_chunk, tasks, jobs,
+                                          context):
+            chunks.append([digest, fp.tell(), len(fragment)])
+            with run_metrics.phase('write'):
+                fp.write(fragment)
+        fp.write(render_page_end().encode('utf-8'))
+    os.replace(page_file + '.tmp', page_file)
+
+    return chunks
+
+
+def write_files(input_dir, previous, manifest):
+    # Remove pages left over from a different page layout
+    for file_name in previous.get('pages', {}):
+        page_file = os.path.join(input_dir, file_name)
+        if file_name not in manifest['pages'] and os.path.exists(page_file):
+            os.remove(page_file)
+    render_manifest.save_render_manifest(input_dir, manifest)
+
+    with open(os.path.join(input_dir, 'main.css'), 'w') as fp:
         fp.write(css_file())
 
     root_path = os.path.realpath(__file__)
     assets_dir = os.path.join(os.path.dirname(root_path), 'assets')
-    project_assets_dir = os.path.join(args.input_dir, 'assets')
+    project_assets_dir = os.path.join(input_dir, 'assets')
     os.makedirs(project_assets_dir, exist_ok=True)
     shutil.copy(os.path.join(assets_dir, 'heart.png'), project_assets_dir)
     shutil.copy(os.path.join(assets_dir, 'heart-full.png'), project_assets_dir)
 
 
+class ServedPages(object):
+    # The pages archive_server.py serves. load() is called again whenever
+    # the archive changes. Rendering is serialized as MessageRenderer
+    # keeps the last minute it formatted.
+    def __init__(self, input_dir, timezone=None):
+        self.input_dir = input_dir
+        self.timezone = timezone
+        root_path = os.path.realpath(__file__)
+        self.assets_dir = os.path.join(os.path.dirname(root_path), 'assets')
+        self.lock = threading.Lock()
+
+    def load(self):
+        with open(os.path.join(self.input_dir, 'people.json')) as fp:
+            people = json_codec.load(fp)
+        with open(os.path.join(self.input_dir, 'group_info.json')) as fp:
+            group_info = json_codec.load(fp)
+        renderer = MessageRenderer(load_media(self.input_dir), people,
+                                   self.timezone)
+        with self.lock:
+            self.group_info = group_info
+            self.renderer = renderer
+
+    def css(self):
+        return css_file()
+
+    def render_index(self, months):
+        return render_month_index(self.group_info, months)
+
+    def render_page(self, messages, nav):
+        parts = [render_page_start(self.group_info, nav)]
+        with self.lock:
+            self.renderer.render(messages, parts.append)
+        parts.append(render_page_end(nav))
+        return ''.join(parts)
+
+
+def load_media(input_dir):
+    media = media_manifest.load_manifest(input_dir)
+    previews = thumbnails.load_thumbnails(input_dir)
+    media['thumbnails'] = previews['thumbnails']
+    media['posters'] = previews['posters']
+    return media
+
+
+def serve(args):
+    tz = None
+    if args.timezone:
+        tz = pytz.timezone(args.timezone)
+
+    pages = ServedPages(args.input_dir, tz)
+    settings = render_manifest.settings_digest(
+        [os.path.realpath(__file__), archive_server.__file__],
+        {'timezone': args.timezone})
+    server = archive_server.make_server(
+        args.input_dir, pages, settings, tz, args.host, args.port,
+        args.cache_size, args.messages_per_page or archive_server.WINDOW_SIZE)
+    # messages.jsonl is scanned once here, and only read in the places
+    # requested pages are in after that
+    archive_server.refresh(server)
+    print("Serving %s on http://%s:%d/" % ((pages.group_info['name'],) +
+                                           server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def load_archive(input_dir, use_sqlite=False):
+    db = None
+    if use_sqlite:
+        db_file = os.path.join(input_dir, archive_sqlite.SQLITE_FILE)
+        if not os.path.exists(db_file):
+            print("Missing files!")
+            sys.exit(1)
+
+        db = archive_sqlite.SqliteArchive(db_file)
+        people = db.load_people()
+        messages = db.iter_messages()
+        group_info = db.load_group_info()
+    else:
+        if not os.path.exists(os.path.join(input_dir, 'people.json')) or \
+           not (message_store.has_messages(input_dir) or
+                segment_store.has_segments(input_dir)) or \
+           not os.path.exists(os.path.join(input_dir, 'group_info.json')):
+            print("Missing files!")
+            sys.exit(1)
+
+        with open(os.path.join(input_dir, 'people.json')) as fp:
+            people = json_codec.load(fp)
+
+        if segment_store.has_segments(input_dir):
+            messages = segment_store.iter_messages(input_dir)
+        else:
+            messages = message_store.iter_messages(input_dir)
+
+        with open(os.path.join(input_dir, 'group_info.json')) as fp:
+            group_info = json_codec.load(fp)
+
+    return db, people, messages, group_info
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
+    parser.add_argument('--timezone', type=str,
+                        help="Timezone to render message times in.")
+    parser.add_argument('--messages-per-page', type=int,
+                        dest='messages_per_page',
+                        help="Split the rendered chat into pages with at " +
+                             "most this many messages.")
+    parser.add_argument('--pages-by-month', action='store_true',
+                        dest='pages_by_month',
+                        help="Split the rendered chat into one page per " +
+                             "month.")
+    parser.add_argument('--sqlite', action='store_true',
+                        help="Read the archive from archive.sqlite " +
+                             "instead of the JSON files.")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of processes to render with.")
+    parser.add_argument('--search-index', action='store_true',
+                        dest='search_index',
+                        help="Build a search index and add a search box " +
+                             "to the rendered pages.")
+    parser.add_argument('--viewer', action='store_true',
+                        help="Save the messages as compact data files with " +
+                             "a viewer that only shows the messages in " +
+                             "view, instead of rendering them to HTML.")
+    parser.add_argument('--metrics-file', dest='metrics_file',
+                        help="Save the time spent loading, rendering and " +
+                             "writing to this file, as JSON or, for files " +
+                             "ending in .prom, in the Prometheus text " +
+                             "format.")
+    parser.add_argument('--full-render', action='store_true',
+                        dest='full_render',
+                        help="Render every page again, instead of only " +
+                             "the pages whose content changed.")
+    parser.add_argument('--serve', action='store_true',
+                        help="Run a local web server that renders months, " +
+                             "days and pages of messages as they are " +
+                             "viewed, instead of rendering the whole chat.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to serve on with --serve.")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="Port to serve on with --serve.")
+    parser.add_argument('--cache-size', type=int, dest='cache_size',
+                        default=archive_server.CACHE_SIZE,
+                        help="Megabytes of rendered pages kept in memory " +
+                             "with --serve (default: %d)." %
+                             (archive_server.CACHE_SIZE))
+
+    args = parser.parse_args()
+
+    if args.viewer and (args.messages_per_page or args.pages_by_month or
+                        args.search_index):
+        parser.error("--viewer cannot be combined with pages or " +
+                     "--search-index")
+    if args.serve and (args.viewer or args.pages_by_month or args.sqlite or
+                       args.search_index):
+        parser.error("--serve cannot be combined with --viewer, " +
+                     "--pages-by-month, --sqlite or --search-index")
+
+    if args.serve:
+        # Only checks that the archive is there, messages are read later
+        load_archive(args.input_dir)
+        if not segment_store.has_segments(args.input_dir) and \
+           not os.path.exists(os.path.join(args.input_dir,
+                                           message_store.MESSAGES_FILE)):
+            print("--serve needs messages.jsonl, convert messages.json " +
+                  "with message_store.py first")
+            sys.exit(1)
+        serve(args)
+        return
+
+    with run_metrics.phase('load'):
+        db, people, messages, group_info = load_archive(args.input_dir,
+                                                        args.sqlite)
+        media = load_media(args.input_dir)
+
+    # Messages are read as they are rendered
+    messages = run_metrics.timed_iter('load', messages, 'messages')
+
+    tz = None
+    if args.timezone:
+        tz = pytz.timezone(args.timezone)
+
+    # Messages are indexed as they are handed out for rendering
+    index = None
+    if args.search_index:
+        index = search_index.SearchIndex(args.input_dir, people, tz)
+    else:
+        search_index.remove_index(args.input_dir)
+
+    # Pages are only rendered again when their messages, the people and
+    # media they show, or the renderer and its options have changed
+    previous = render_manifest.load_render_manifest(args.input_dir)
+    settings = render_manifest.settings_digest(
+        [os.path.realpath(__file__), search_index.__file__],
+        {'group_info': group_info, 'timezone': args.timezone,
+         'search': args.search_index, 'viewer': args.viewer})
+    reusable = previous
+    if args.full_render or previous.get('settings') != settings:
+        reusable = {}
+    manifest = {'settings': settings, 'pages': {}, 'chunks': []}
+    # Every run replaces rendered.html before saving its manifest, so the
+    # offsets of the old chunks are dropped first in case it is stopped in
+    # between
+    if previous.get('chunks'):
+        render_manifest.save_render_manifest(args.input_dir,
+                                             dict(previous, chunks=[]))
+
+    # Save rendered files
+    with run_metrics.phase('render'):
+        # --full-render skips digesting pages, which is about as much work
+        # as rendering them
+        context = (args.input_dir, group_info, people, media, tz,
+                   args.search_index,
+                   None if args.full_render else settings, reusable)
+        if args.viewer:
+            manifest['pages'] = chat_viewer.write_viewer(
+                args.input_dir, people, media, messages, __SYSTEM__,
+                args.timezone, tz, reusable)
+            page = render_viewer_page(group_info)
+            with run_metrics.phase('write'):
+                with open(os.path.join(args.input_dir, 'rendered.html'),
+                          'w') as fp:
+                    fp.write(page)
+        elif args.messages_per_page or args.pages_by_month:
+            pages = paginate(messages, args.messages_per_page,
+                             args.pages_by_month, tz)
+            if index is not None:
+                pages = ((file_name, label,
+                          list(index.add_messages(page, file_name)))
+                         for file_name, label, page in pages)
+            manifest['pages'] = write_pages(
+                args.input_dir, group_info, pages, args.jobs, context, tz,
+                args.search_index)
+        else:
+            # Without a search index nothing here needs the messages, so
+            # the workers are sent the lines of messages.jsonl to parse
+            messages_file = os.path.join(args.input_dir,
+                                         message_store.MESSAGES_FILE)
+            parse = index is None and not args.sqlite and \
+                not segment_store.has_segments(args.input_dir) and \
+                os.path.exists(messages_file)
+            if parse:
+                messages = run_metrics.timed_iter(
+                    'load', message_store.iter_lines_file(messages_file),
+                    'messages')
+            elif index is not None:
+                messages = index.add_messages(messages, 'rendered.html')
+            manifest['chunks'] = write_single_page(
+                args.input_dir, group_info, messages, args.jobs, context,
+                args.search_index, parse)
+
+    if index is not None:
+        with run_metrics.phase('search_index'):
+            index.finish()
+
+    with run_metrics.phase('write'):
+        write_files(args.input_dir, previous, manifest)
+
+    if db is not None:
+        db.close()
+
+    if args.metrics_file:
+        run_metrics.metrics.save(args.metrics_file, 'render_chat')
+
+
 if __name__ == '__main__':
     main()
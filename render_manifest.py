@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+
+import media_manifest
+
+RENDER_MANIFEST_FILE = "render_manifest.json"
+
+
+def load_render_manifest(archive_dir):
+    manifest_file = os.path.join(archive_dir, RENDER_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, encoding='utf-8') as fp:
+            return json.load(fp)
+    except ValueError:
+        return {}
+
+
+def save_render_manifest(archive_dir, manifest):
+    manifest_file = os.path.join(archive_dir, RENDER_MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def settings_digest(source_files, settings):
+    # Changes to the renderer itself or its options invalidate every page
+    digest = hashlib.sha1()
+    for source_file in source_files:
+        with open(source_file, 'rb') as fp:
+            digest.update(fp.read())
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def content_digest(settings, people, media, messages, extra=None):
+    # Only the people and media a page refers to are part of its digest,
+    # so new avatars or members only rebuild the pages that show them
+    digest = hashlib.sha1(settings.encode('utf-8'))
+    digest.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+
+    user_ids = set()
+    attachment_keys = set()
+    for message in messages:
+        digest.update(json.dumps(message.to_dict(), sort_keys=True,
+                                 ensure_ascii=False).encode('utf-8'))
+        user_ids.add(message.author)
+        user_ids.update(message.favorited_by)
+        for att in message.attachments:
+            if att.get('url'):
+                attachment_keys.add(media_manifest.attachment_key(att['url']))
+
+    references = {
+        'people': {k: people.get(k) for k in user_ids},
+        'avatars': {k: media['avatars'].get(k) for k in user_ids}
+    }
+    for kind in media:
+        if kind != 'avatars':
+            references[kind] = {k: media[kind].get(k)
+                                for k in attachment_keys}
+    digest.update(json.dumps(references, sort_keys=True,
+                             ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
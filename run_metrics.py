@@ -0,0 +1,261 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, float('inf'))
+METRIC_PREFIX = 'groupme'
+
+# The phases open in the current thread or task, innermost last. Worker
+# threads are given the caller's phases with contextvars.copy_context(),
+# and asyncio tasks inherit them from the thread that submitted them.
+current_phases = contextvars.ContextVar('current_phases', default=())
+
+
+class PhaseMetrics(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.counters = {}
+        self.clients = {}
+
+    def client(self, name):
+        if name not in self.clients:
+            self.clients[name] = {
+                'statuses': {},
+                'bytes': 0,
+                'retries': 0,
+                'retry_wait': 0.0,
+                'latency_buckets': [0] * len(LATENCY_BUCKETS),
+                'latency_sum': 0.0,
+                'latency_count': 0
+            }
+        return self.clients[name]
+
+
+class RunMetrics(object):
+    # Time spent in each phase of a run, not counting the phases nested in
+    # it, along with counters and per-client request statistics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+
+    def get_phase(self, name):
+        if name is None:
+            name = 'other'
+        if name not in self.phases:
+            self.phases[name] = PhaseMetrics()
+        return self.phases[name]
+
+    def add_seconds(self, name, seconds, calls=1):
+        with self.lock:
+            phase = self.get_phase(name)
+            phase.seconds += seconds
+            phase.calls += calls
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            counters = self.get_phase(phase_name()).counters
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def record_request(self, client, status, latency=None):
+        with self.lock:
+            stats = self.get_phase(phase_name()).client(client)
+            status = str(status)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            if latency is not None:
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        stats['latency_buckets'][i] += 1
+                        break
+                stats['latency_sum'] += latency
+                stats['latency_count'] += 1
+
+    def record_bytes(self, client, num_bytes):
+        with self.lock:
+            self.get_phase(phase_name()).client(client)['bytes'] += num_bytes
+
+    def record_retry(self, client, delay):
+        with self.lock:
+            stats = self.get_phase(phase_name()).client(client)
+            stats['retries'] += 1
+            stats['retry_wait'] += delay
+
+    def to_json(self, script):
+        phases = {}
+        for name, phase in sorted(self.phases.items()):
+            clients = {}
+            for client, stats in sorted(phase.clients.items()):
+                buckets = {}
+                total = 0
+                for bound, num in zip(LATENCY_BUCKETS,
+                                      stats['latency_buckets']):
+                    total += num
+                    buckets['+Inf' if bound == float('inf') else
+                            str(bound)] = total
+                clients[client] = {
+                    'requests': sum(stats['statuses'].values()),
+                    'statuses': stats['statuses'],
+                    'bytes': stats['bytes'],
+                    'retries': stats['retries'],
+                    'retry_wait_seconds': round(stats['retry_wait'], 6),
+                    'latency_seconds': {
+                        'buckets': buckets,
+                        'sum': round(stats['latency_sum'], 6),
+                        'count': stats['latency_count']
+                    }
+                }
+            phases[name] = {
+                'seconds': round(phase.seconds, 6),
+                'calls': phase.calls,
+                'counters': phase.counters,
+                'clients': clients
+            }
+        # Worker processes only count once they have exited, as they have
+        # by the time a run saves its metrics
+        times = os.times()
+        return {
+            'script': script,
+            'started_at': self.started_at,
+            'seconds': round(time.perf_counter() - self.start, 6),
+            'cpu_seconds': {
+                'process': round(times.user + times.system, 6),
+                'workers': round(times.children_user +
+                                 times.children_system, 6)
+            },
+            'phases': phases
+        }
+
+    def to_prometheus(self, script):
+        data = self.to_json(script)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            if not samples:
+                return
+            name = '%s_%s' % (METRIC_PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = dict(labels, script=script)
+                lines.append('%s%s{%s} %s' % (name, suffix, ','.join(
+                    '%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in sorted(labels.items())), value))
+
+        phases = data['phases']
+        clients = [(phase, client, stats)
+                   for phase, p in phases.items()
+                   for client, stats in p['clients'].items()]
+        metric('run_seconds', 'gauge', "Duration of the run",
+               [('', {}, data['seconds'])])
+        metric('run_start_time_seconds', 'gauge', "Start time of the run",
+               [('', {}, data['started_at'])])
+        metric('cpu_seconds', 'gauge',
+               "CPU time of the run and of its worker processes",
+               [('', {'process': process}, seconds)
+                for process, seconds in sorted(data['cpu_seconds'].items())])
+        metric('phase_seconds', 'gauge', "Time spent in each phase",
+               [('', {'phase': phase}, p['seconds'])
+                for phase, p in phases.items()])
+        metric('phase_items', 'gauge', "Items handled in each phase",
+               [('', {'phase': phase, 'item': item}, value)
+                for phase, p in phases.items()
+                for item, value in sorted(p['counters'].items())])
+        metric('requests', 'gauge', "HTTP requests by response status",
+               [('', {'phase': phase, 'client': client, 'status': status},
+                 num)
+                for phase, client, stats in clients
+                for status, num in sorted(stats['statuses'].items())])
+        metric('response_bytes', 'gauge', "Bytes received",
+               [('', {'phase': phase, 'client': client}, stats['bytes'])
+                for phase, client, stats in clients])
+        metric('retries', 'gauge', "Requests retried",
+               [('', {'phase': phase, 'client': client}, stats['retries'])
+                for phase, client, stats in clients])
+        metric('retry_wait_seconds', 'gauge', "Time spent waiting to retry",
+               [('', {'phase': phase, 'client': client},
+                 stats['retry_wait_seconds'])
+                for phase, client, stats in clients])
+
+        samples = []
+        for phase, client, stats in clients:
+            labels = {'phase': phase, 'client': client}
+            latency = stats['latency_seconds']
+            for bound, num in latency['buckets'].items():
+                samples.append(('_bucket', dict(labels, le=bound), num))
+            samples.append(('_sum', labels, latency['sum']))
+            samples.append(('_count', labels, latency['count']))
+        metric('request_latency_seconds', 'histogram',
+               "HTTP request latency", samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path, script):
+        # Files ending in .prom are written for the Prometheus textfile
+        # collector, anything else as JSON
+        if path.endswith('.prom'):
+            content = self.to_prometheus(script)
+        else:
+            content = json.dumps(self.to_json(script), indent=2)
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(content)
+        os.replace(path + '.tmp', path)
+
+
+metrics = RunMetrics()
+
+
+def phase_name():
+    phases = current_phases.get()
+    return phases[-1][0] if phases else None
+
+
+@contextmanager
+def phase(name):
+    # Each open phase keeps the time spent in the phases nested in it, so
+    # that it can be left out of its own
+    frame = [name, 0.0]
+    token = current_phases.set(current_phases.get() + (frame,))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current_phases.reset(token)
+        metrics.add_seconds(name, elapsed - frame[1])
+        parents = current_phases.get()
+        if parents:
+            parents[-1][1] += elapsed
+
+
+def timed_iter(name, iterable, counter=None):
+    # Counts the time spent getting each item as the phase name, without
+    # the overhead of entering a phase for every item
+    parents = current_phases.get()
+    iterator = iter(iterable)
+    elapsed = 0.0
+    num_items = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            num_items += 1
+            yield item
+    finally:
+        metrics.add_seconds(name, elapsed, 0)
+        if parents:
+            parents[-1][1] += elapsed
+        if counter:
+            with metrics.lock:
+                counters = metrics.get_phase(name).counters
+                counters[counter] = counters.get(counter, 0) + num_items
@@ -0,0 +1,299 @@
+import json
+import os
+import re
+import shutil
+from array import array
+from collections import defaultdict
+from datetime import datetime
+
+SEARCH_DIR = "search"
+NUM_SHARDS = 256
+DOC_CHUNK_SIZE = 500
+SNIPPET_LENGTH = 200
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Data files are plain scripts rather than JSON so that they can be loaded
+# from archives opened straight from disk (file:// urls cannot be fetched)
+SEARCH_JS = r"""(function () {
+    var BASE = 'search/';
+    var MAX_RESULTS = 50;
+    var loaded = {};
+    var waiting = {};
+    var current = 0;
+
+    function load(name, callback) {
+        if (name in loaded) {
+            callback(loaded[name]);
+            return;
+        }
+        if (waiting[name]) {
+            waiting[name].push(callback);
+            return;
+        }
+        waiting[name] = [callback];
+        var script = document.createElement('script');
+        script.src = BASE + name + '.js';
+        document.head.appendChild(script);
+    }
+
+    window.groupmeSearchLoaded = function (name, data) {
+        loaded[name] = data;
+        var callbacks = waiting[name] || [];
+        delete waiting[name];
+        callbacks.forEach(function (callback) { callback(data); });
+    };
+
+    function tokenize(text) {
+        var tokens = text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+        return tokens.filter(function (token, i) {
+            return tokens.indexOf(token) === i;
+        });
+    }
+
+    function shardOf(token, numShards) {
+        // FNV-1a over the UTF-8 bytes, as in search_index.py
+        var bytes = new TextEncoder().encode(token);
+        var hash = 0x811c9dc5;
+        for (var i = 0; i < bytes.length; i++) {
+            hash ^= bytes[i];
+            hash = Math.imul(hash, 0x01000193) >>> 0;
+        }
+        return hash % numShards;
+    }
+
+    function decode(deltas) {
+        var ids = [];
+        var id = 0;
+        for (var i = 0; i < deltas.length; i++) {
+            id += deltas[i];
+            ids.push(id);
+        }
+        return ids;
+    }
+
+    function intersect(a, b) {
+        var result = [];
+        var i = 0;
+        var j = 0;
+        while (i < a.length && j < b.length) {
+            if (a[i] === b[j]) {
+                result.push(a[i]);
+                i++;
+                j++;
+            } else if (a[i] < b[j]) {
+                i++;
+            } else {
+                j++;
+            }
+        }
+        return result;
+    }
+
+    function search(query, done) {
+        var tokens = tokenize(query);
+        if (tokens.length === 0) {
+            done(null, []);
+            return;
+        }
+        load('meta', function (meta) {
+            var lists = [];
+            var remaining = tokens.length;
+            tokens.forEach(function (token, i) {
+                var shard = shardOf(token, meta.shards);
+                load('shard-' + shard, function (postings) {
+                    lists[i] = postings[token] ? decode(postings[token]) : [];
+                    remaining--;
+                    if (remaining === 0) {
+                        done(meta, lists.reduce(intersect));
+                    }
+                });
+            });
+        });
+    }
+
+    function show(meta, ids, results, query) {
+        results.textContent = '';
+        if (meta === null) {
+            return;
+        }
+        var summary = document.createElement('div');
+        summary.className = 'search_summary';
+        summary.textContent = ids.length + ' messages found';
+        results.appendChild(summary);
+
+        // Newest first, loading only the document chunks that are shown
+        var shown = ids.slice(-MAX_RESULTS).reverse();
+        var rows = shown.map(function () {
+            var row = document.createElement('a');
+            row.className = 'search_result';
+            results.appendChild(row);
+            return row;
+        });
+        shown.forEach(function (id, i) {
+            var chunk = Math.floor(id / meta.chunk_size);
+            load('docs-' + chunk, function (docs) {
+                if (query !== current) {
+                    return;
+                }
+                var doc = docs[id - chunk * meta.chunk_size];
+                var page = meta.pages[doc[0]];
+                rows[i].href = doc[1] ? page + '#' + doc[1] : page;
+
+                var header = document.createElement('span');
+                header.className = 'user';
+                header.textContent = meta.authors[doc[2]] + ' - ' + doc[3];
+                var text = document.createElement('span');
+                text.className = 'message';
+                text.textContent = doc[4];
+                rows[i].appendChild(header);
+                rows[i].appendChild(text);
+            });
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        var input = document.getElementById('search_input');
+        var results = document.getElementById('search_results');
+        var timer = null;
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+                var query = ++current;
+                search(input.value, function (meta, ids) {
+                    if (query === current) {
+                        show(meta, ids, results, query);
+                    }
+                });
+            }, 200);
+        });
+    });
+})();
+"""
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def shard_of(token, num_shards):
+    # FNV-1a, mirrored by shardOf() in SEARCH_JS
+    token_hash = 0x811c9dc5
+    for byte in token.encode('utf-8'):
+        token_hash = ((token_hash ^ byte) * 0x01000193) & 0xffffffff
+    return token_hash % num_shards
+
+
+def message_anchor(message):
+    # Archives made before message ids were stored have no anchors
+    if message.id is None:
+        return None
+    return 'm%s' % (message.id)
+
+
+def write_data_file(search_dir, name, data):
+    with open(os.path.join(search_dir, '%s.js' % (name)), 'w',
+              encoding='utf-8') as fp:
+        fp.write('groupmeSearchLoaded(%s, ' % (json.dumps(name)))
+        json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
+        fp.write(');\n')
+
+
+def remove_index(output_dir):
+    # Shards and document chunks of an earlier index would otherwise still
+    # be loaded by the search box
+    shutil.rmtree(os.path.join(output_dir, SEARCH_DIR), ignore_errors=True)
+
+
+class SearchIndex(object):
+    # Inverted index over message text and author names. Postings are kept
+    # as compact arrays of document ids while rendering, and written out
+    # as hash sharded, delta encoded files once all messages are seen.
+    # Document details are written in fixed size chunks as they fill up.
+    def __init__(self, output_dir, people, timezone=None,
+                 num_shards=NUM_SHARDS):
+        self.search_dir = os.path.join(output_dir, SEARCH_DIR)
+        remove_index(output_dir)
+        os.makedirs(self.search_dir, exist_ok=True)
+
+        self.people = people
+        self.timezone = timezone
+        self.num_shards = num_shards
+
+        self.postings = defaultdict(lambda: array('I'))
+        self.pages = []
+        self.page_ids = {}
+        self.authors = []
+        self.author_ids = {}
+        self.author_tokens = {}
+
+        self.num_docs = 0
+        self.num_chunks = 0
+        self.chunk = []
+
+    def add_message(self, message, page):
+        doc_id = self.num_docs
+        self.num_docs += 1
+
+        if page not in self.page_ids:
+            self.page_ids[page] = len(self.pages)
+            self.pages.append(page)
+
+        author = message.author
+        if author not in self.author_ids:
+            name = self.people[author]['name'] if author in self.people \
+                else author
+            self.author_ids[author] = len(self.authors)
+            self.authors.append(name)
+            self.author_tokens[author] = set(tokenize(name))
+
+        for token in set(tokenize(message.text)) | \
+                self.author_tokens[author]:
+            self.postings[token].append(doc_id)
+
+        created_at = datetime.fromtimestamp(message.created_at,
+                                            self.timezone)
+        self.chunk.append([
+            self.page_ids[page],
+            message_anchor(message),
+            self.author_ids[author],
+            created_at.strftime('%b %d, %Y'),
+            (message.text or '')[:SNIPPET_LENGTH]
+        ])
+        if len(self.chunk) == DOC_CHUNK_SIZE:
+            self.flush_chunk()
+
+    def add_messages(self, messages, page):
+        for message in messages:
+            self.add_message(message, page)
+            yield message
+
+    def flush_chunk(self):
+        write_data_file(self.search_dir, 'docs-%d' % (self.num_chunks),
+                        self.chunk)
+        self.num_chunks += 1
+        self.chunk = []
+
+    def finish(self):
+        if self.chunk:
+            self.flush_chunk()
+
+        shards = [{} for _ in range(self.num_shards)]
+        for token, doc_ids in self.postings.items():
+            deltas = [doc_ids[0]]
+            deltas += [b - a for a, b in zip(doc_ids, doc_ids[1:])]
+            shards[shard_of(token, self.num_shards)][token] = deltas
+        self.postings.clear()
+
+        for i, shard in enumerate(shards):
+            write_data_file(self.search_dir, 'shard-%d' % (i), shard)
+
+        write_data_file(self.search_dir, 'meta', {
+            'shards': self.num_shards,
+            'chunk_size': DOC_CHUNK_SIZE,
+            'pages': self.pages,
+            'authors': self.authors
+        })
+
+        with open(os.path.join(self.search_dir, 'search.js'), 'w') as fp:
+            fp.write(SEARCH_JS)
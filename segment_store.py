@@ -0,0 +1,265 @@
+import argparse
+import gzip
+import io
+import os
+import sys
+
+import json_codec
+import message_store
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENTS_DIR = "segments"
+INDEX_FILE = "index.json"
+SEGMENT_SIZE = 5000
+ZSTD_LEVEL = 9
+
+CODECS = ('gzip', 'zstd')
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    # Without a timestamp, the same messages always compress to the same
+    # bytes, which keeps backups of unchanged segments incremental.
+    # gzip.compress() only takes mtime from Python 3.8.
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as fp:
+        fp.write(data)
+    return buffer.getvalue()
+
+
+def decompress(data, file_name):
+    if file_name.endswith(EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise RuntimeError("Reading %s requires the zstandard package" %
+                               (file_name))
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def has_segments(archive_dir):
+    return os.path.exists(os.path.join(archive_dir, SEGMENTS_DIR, INDEX_FILE))
+
+
+def load_index(archive_dir):
+    # Lists the segments in message order, with the first and last message
+    # id and the earliest and latest message time of each, so that readers
+    # only decompress the segments a range of messages falls in
+    index_file = os.path.join(archive_dir, SEGMENTS_DIR, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return {'codec': None, 'segment_size': None, 'segments': []}
+    with open(index_file, encoding='utf-8') as fp:
+        return json_codec.load(fp)
+
+
+def save_index(archive_dir, index):
+    index_file = os.path.join(archive_dir, SEGMENTS_DIR, INDEX_FILE)
+    with open(index_file + '.tmp', 'w', encoding='utf-8') as fp:
+        json_codec.dump(index, fp, indent=2)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def last_message_id(archive_dir):
+    segments = load_index(archive_dir)['segments']
+    return segments[-1]['last_id'] if segments else None
+
+
+def read_segment(archive_dir, entry):
+    path = os.path.join(archive_dir, SEGMENTS_DIR, entry['file'])
+    with open(path, 'rb') as fp:
+        data = decompress(fp.read(), entry['file'])
+    messages = []
+    for line in data.split(b'\n'):
+        message = message_store.parse_line(line) if line else None
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+def write_segment(archive_dir, number, messages, codec):
+    # Named after the segment's position and size, so that a segment that
+    # is appended to goes to a new file and the index never points at a
+    # file with other messages than it lists
+    file_name = '%06d.%d%s' % (number, len(messages), EXTENSIONS[codec])
+    lines = []
+    for message in messages:
+        lines.append(json_codec.dumps(message.to_dict()))
+    lines.append('')
+    path = os.path.join(archive_dir, SEGMENTS_DIR, file_name)
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(compress('\n'.join(lines).encode('utf-8'), codec))
+    os.replace(path + '.tmp', path)
+
+    times = [message.created_at for message in messages]
+    return {'file': file_name, 'count': len(messages),
+            'first_id': messages[0].id, 'last_id': messages[-1].id,
+            'start_time': min(times), 'end_time': max(times)}
+
+
+def remove_unlisted(archive_dir, index):
+    # Segments replaced by a later write, or left by an interrupted one
+    listed = set(entry['file'] for entry in index['segments'])
+    segments_dir = os.path.join(archive_dir, SEGMENTS_DIR)
+    for entry in os.scandir(segments_dir):
+        if entry.name != INDEX_FILE and entry.name not in listed:
+            os.remove(entry.path)
+
+
+def append_messages(archive_dir, messages, codec=None, segment_size=None,
+                    replace=False):
+    # Messages are appended to the last segment until it holds
+    # segment_size of them. Messages the archive already has, which a run
+    # stopped before removing messages.jsonl would hand over again, are
+    # skipped.
+    os.makedirs(os.path.join(archive_dir, SEGMENTS_DIR), exist_ok=True)
+    index = load_index(archive_dir)
+    if replace:
+        index['segments'] = []
+    codec = codec or index['codec'] or 'gzip'
+    segment_size = segment_size or index['segment_size'] or SEGMENT_SIZE
+    index['codec'] = codec
+    index['segment_size'] = segment_size
+    segments = index['segments']
+
+    last_id = segments[-1]['last_id'] if segments else None
+    partial = None
+    if segments and segments[-1]['count'] < segment_size:
+        partial = segments[-1]
+    pending = []
+
+    num_messages = 0
+    for message in messages:
+        if last_id is not None and message.id is not None and \
+           int(message.id) <= int(last_id):
+            continue
+        if partial is not None:
+            # Only rewritten once there is something to add to it
+            pending = read_segment(archive_dir, segments.pop())
+            partial = None
+        pending.append(message)
+        num_messages += 1
+        if len(pending) == segment_size:
+            segments.append(write_segment(archive_dir, len(segments),
+                                          pending, codec))
+            pending = []
+    if pending:
+        segments.append(write_segment(archive_dir, len(segments), pending,
+                                      codec))
+
+    save_index(archive_dir, index)
+    remove_unlisted(archive_dir, index)
+    return num_messages
+
+
+def pack_messages_file(archive_dir, codec=None, segment_size=None,
+                       replace=False):
+    # Moves the messages appended to messages.jsonl into segments
+    messages_file = os.path.join(archive_dir, message_store.MESSAGES_FILE)
+    if not os.path.exists(messages_file):
+        return 0
+    num_messages = append_messages(
+        archive_dir, message_store.iter_messages_file(messages_file), codec,
+        segment_size, replace)
+    os.remove(messages_file)
+    return num_messages
+
+
+def overlaps(entry, first_id, last_id, start_time, end_time):
+    if first_id is not None and entry['last_id'] is not None and \
+       int(entry['last_id']) < int(first_id):
+        return False
+    if last_id is not None and entry['first_id'] is not None and \
+       int(entry['first_id']) > int(last_id):
+        return False
+    if start_time is not None and entry['end_time'] < start_time:
+        return False
+    if end_time is not None and entry['start_time'] >= end_time:
+        return False
+    return True
+
+
+def matches(message, first_id, last_id, start_time, end_time):
+    if message.id is not None:
+        if first_id is not None and int(message.id) < int(first_id):
+            return False
+        if last_id is not None and int(message.id) > int(last_id):
+            return False
+    if start_time is not None and message.created_at < start_time:
+        return False
+    if end_time is not None and message.created_at >= end_time:
+        return False
+    return True
+
+
+def iter_messages(archive_dir, first_id=None, last_id=None, start_time=None,
+                  end_time=None):
+    # Yields the messages with ids from first_id to last_id and times from
+    # start_time up to end_time, decompressing only the segments that have
+    # any. Messages still in messages.jsonl, from a run that has not packed
+    # them yet, come last.
+    archive_last_id = None
+    for entry in load_index(archive_dir)['segments']:
+        archive_last_id = entry['last_id']
+        if not overlaps(entry, first_id, last_id, start_time, end_time):
+            continue
+        for message in read_segment(archive_dir, entry):
+            if matches(message, first_id, last_id, start_time, end_time):
+                yield message
+
+    messages_file = os.path.join(archive_dir, message_store.MESSAGES_FILE)
+    if not os.path.exists(messages_file):
+        return
+    for message in message_store.iter_messages_file(messages_file):
+        if archive_last_id is not None and message.id is not None and \
+           int(message.id) <= int(archive_last_id):
+            continue
+        if matches(message, first_id, last_id, start_time, end_time):
+            yield message
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Pack an archive's
+        messages into compressed segments with an index, which
+        render_chat.py reads instead of messages.jsonl.
+        """)
+    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
+    parser.add_argument('--codec', choices=CODECS,
+                        help="Compression for the segments (default: gzip, " +
+                             "or the codec the archive was packed with). " +
+                             "zstd needs the zstandard package.")
+    parser.add_argument('--segment-size', type=int, dest='segment_size',
+                        help="Number of messages per segment (default: %d)" %
+                             (SEGMENT_SIZE))
+
+    args = parser.parse_args()
+
+    if args.codec == 'zstd' and zstandard is None:
+        print("--codec zstd requires the zstandard package")
+        sys.exit(1)
+
+    if has_segments(args.input_dir):
+        num_messages = pack_messages_file(args.input_dir, args.codec,
+                                          args.segment_size)
+    elif message_store.has_messages(args.input_dir):
+        # messages.json of older archives is left in place, as
+        # message_store.py does
+        num_messages = append_messages(
+            args.input_dir, message_store.iter_messages(args.input_dir),
+            args.codec, args.segment_size)
+        messages_file = os.path.join(args.input_dir,
+                                     message_store.MESSAGES_FILE)
+        if os.path.exists(messages_file):
+            os.remove(messages_file)
+    else:
+        print("Missing files!")
+        sys.exit(1)
+    print("Packed %d messages" % (num_messages))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+
+from tqdm import tqdm
+
+import json_codec
+import media_manifest
+from downloader import CHUNK_SIZE, part_path_for
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+THUMBNAILS_FILE = "thumbnails.json"
+THUMBNAILS_DIR = "thumbnails"
+THUMBNAIL_SIZE = 400
+POSTER_TIMEOUT = 120
+
+# Attachment file extensions come from the content type they were served
+# with. GIFs are left alone so that they stay animated.
+IMAGE_TYPES = ('jpeg', 'jpg', 'png', 'webp', 'bmp', 'tiff')
+VIDEO_TYPES = ('mp4', 'quicktime', 'webm', 'mpeg', '3gpp', 'x-m4v',
+               'x-msvideo')
+
+# Attachments that fail with these are shown at full size instead. Images
+# over Pillow's pixel limit raise DecompressionBombError, which is not an
+# OSError.
+PROCESS_ERRORS = (OSError, ValueError, subprocess.SubprocessError)
+if Image is not None:
+    PROCESS_ERRORS += (Image.DecompressionBombError,)
+
+
+def media_kind(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext in IMAGE_TYPES:
+        return 'thumbnails'
+    if ext in VIDEO_TYPES:
+        return 'posters'
+    return None
+
+
+def source_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_thumbnail(source_path, output_path, size):
+    # Returns False for images that are already small enough to show as is
+    with Image.open(source_path) as image:
+        if image.width <= size and image.height <= size:
+            return False
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        part_path = part_path_for(output_path)
+        image.save(part_path, 'JPEG', quality=80, optimize=True)
+    os.replace(part_path, output_path)
+    return True
+
+
+def make_poster(source_path, output_path, size):
+    part_path = part_path_for(output_path)
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-y', '-i', source_path,
+         '-frames:v', '1',
+         '-vf', 'scale=%d:%d:force_original_aspect_ratio=decrease' % (
+             size, size),
+         '-f', 'mjpeg', part_path],
+        check=True, stdin=subprocess.DEVNULL, timeout=POSTER_TIMEOUT)
+    os.replace(part_path, output_path)
+    return True
+
+
+def process_media(archive_dir, kind, path, digest, size):
+    # Runs in a worker process. Outputs are named after the hash of their
+    # source, so the same photo posted twice is only processed once.
+    source_path = os.path.join(archive_dir, path)
+    if digest is None:
+        digest = source_hash(source_path)
+
+    if kind == 'thumbnails':
+        output = '%s/%s.jpg' % (THUMBNAILS_DIR, digest)
+    else:
+        output = '%s/%s.poster.jpg' % (THUMBNAILS_DIR, digest)
+    output_path = os.path.join(archive_dir, output)
+
+    if not os.path.exists(output_path):
+        make = make_thumbnail if kind == 'thumbnails' else make_poster
+        if not make(source_path, output_path, size):
+            output = None
+    return digest, output
+
+
+def load_thumbnails(archive_dir):
+    thumbnails_file = os.path.join(archive_dir, THUMBNAILS_FILE)
+    if not os.path.exists(thumbnails_file):
+        return {'size': THUMBNAIL_SIZE, 'sources': {}, 'thumbnails': {},
+                'posters': {}}
+    with open(thumbnails_file, encoding='utf-8') as fp:
+        return json_codec.load(fp)
+
+
+def save_thumbnails(archive_dir, thumbnails):
+    thumbnails_file = os.path.join(archive_dir, THUMBNAILS_FILE)
+    with open(thumbnails_file + '.tmp', 'w', encoding='utf-8') as fp:
+        json_codec.dump(thumbnails, fp, indent=2)
+    os.replace(thumbnails_file + '.tmp', thumbnails_file)
+
+
+def generate_thumbnails(archive_dir, jobs=None, size=THUMBNAIL_SIZE,
+                        progress=True):
+    # Makes thumbnails for image attachments and poster frames for videos.
+    # Sources are remembered by size and modification time, so that only
+    # new or changed attachments are hashed and processed on later runs.
+    # Returns the number of attachments processed and the number failed.
+    kinds = []
+    if Image is not None:
+        kinds.append('thumbnails')
+    else:
+        print("Pillow is not installed, skipping image thumbnails")
+    if shutil.which('ffmpeg'):
+        kinds.append('posters')
+    else:
+        print("ffmpeg is not installed, skipping video poster frames")
+
+    thumbnails = load_thumbnails(archive_dir)
+    if thumbnails['size'] != size:
+        thumbnails = {'size': size, 'sources': {}, 'thumbnails': {},
+                      'posters': {}}
+    os.makedirs(os.path.join(archive_dir, THUMBNAILS_DIR), exist_ok=True)
+
+    tasks = {}
+    for key, path in media_manifest.load_manifest(
+            archive_dir)['attachments'].items():
+        kind = media_kind(path)
+        source_path = os.path.join(archive_dir, path)
+        if kind not in kinds or not os.path.exists(source_path):
+            continue
+
+        stat = os.stat(source_path)
+        source = [path, stat.st_size, stat.st_mtime_ns]
+        known = thumbnails['sources'].get(key)
+        digest = known[3] if known and known[:3] == source else None
+        if digest is not None and key in thumbnails[kind]:
+            output = thumbnails[kind][key]
+            if output is None or os.path.exists(os.path.join(archive_dir,
+                                                             output)):
+                continue
+        tasks[key] = (kind, source, digest)
+
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process_media, archive_dir, kind,
+                                   source[0], digest, size): key
+                   for key, (kind, source, digest) in tasks.items()}
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           disable=not progress):
+            key = futures[future]
+            kind, source, _ = tasks[key]
+            try:
+                digest, output = future.result()
+            except PROCESS_ERRORS as e:
+                tqdm.write("Failed to process %s: %s" % (source[0], e))
+                thumbnails['sources'].pop(key, None)
+                thumbnails[kind].pop(key, None)
+                num_failed += 1
+                continue
+            thumbnails['sources'][key] = source + [digest]
+            thumbnails[kind][key] = output
+
+    save_thumbnails(archive_dir, thumbnails)
+    return len(tasks), num_failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Make thumbnails of
+        image attachments and poster frames of video attachments, which
+        render_chat.py then shows instead of the full size files. Needs
+        Pillow for images and ffmpeg for videos.
+        """)
+    parser.add_argument('--input-dir', '-i', dest='input_dir', required=True)
+    parser.add_argument('--jobs', '-j', type=int,
+                        help="Number of processes to use (default: one " +
+                             "per CPU).")
+    parser.add_argument('--size', type=int, default=THUMBNAIL_SIZE,
+                        help="Largest width or height of a thumbnail, in " +
+                             "pixels.")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.input_dir, 'attachments')):
+        print("Missing files!")
+        sys.exit(1)
+
+    num_processed, num_failed = generate_thumbnails(args.input_dir,
+                                                    args.jobs, args.size)
+    print("Processed %d attachments, %d failed" % (num_processed,
+                                                   num_failed))
+
+
+if __name__ == '__main__':
+    main()